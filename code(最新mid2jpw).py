@@ -1,11 +1,9 @@
 # -*- coding: utf-8 -*-
 import re
-import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
-from math import pow
+import functools
+import io
+from xml.sax.saxutils import escape
 import os
-import datetime # For encoding date
-import argparse # For command-line arguments
 
 # --- Configuration & Mappings ---
 KEY_SIGNATURE_FIFTHS = -1 # F Major / D minor (1 flat)
@@ -14,6 +12,9 @@ NOTE_MAP_F_MAJOR = {
     '1': ('F', 4), '2': ('G', 4), '3': ('A', 4), '4': ('B', 4), # B needs flat unless altered
     '5': ('C', 5), '6': ('D', 5), '7': ('E', 5)
 }
+# Dense views of NOTE_MAP_F_MAJOR indexed by int(note_num); slot 0 is unused
+STEPS_F_MAJOR = (None,) + tuple(NOTE_MAP_F_MAJOR[str(n)][0] for n in range(1, 8))
+BASE_OCTAVES_F_MAJOR = (0,) + tuple(NOTE_MAP_F_MAJOR[str(n)][1] for n in range(1, 8))
 DIVISIONS = 4 # Divisions per quarter note
 BASE_DURATION_DIVISIONS = DIVISIONS # Quarter note = 4 divisions
 DURATION_MAP = {
@@ -27,104 +28,157 @@ DURATION_MAP = {
     16: 'whole'
     # Add more if needed
 }
+# Note/rest + underscore + dot order, and tuplet structure (compiled once at import)
+NOTE_PATTERN = re.compile(
+    r"([#b]?)([1-7])(g*)(_*)(\.*)" +   # Note Grp 1-5 (Underscores G4, Dots G5)
+    r"|(\{\((\d+)\}(.*?)\))" +         # Tuplet Grp 6(Marker G7 (\d+), Content G8) -> Note: G7 is digit only
+    r"|(\$\((.*?)\))" +                # Directive Grp 9(Content G10)
+    r"|(0)(_*)(\.*)"                    # Rest Grp 11(Underscores G12, Dots G13)
+)
+# Tuplet bodies only ever hold notes and rests, so they are scanned with the note/rest branches alone
+TUPLET_NOTE_PATTERN = re.compile(
+    r"([#b]?)([1-7])(g*)(_*)(\.*)" +   # Note Grp 1-5
+    r"|(0)(_*)(\.*)"                    # Rest Grp 6(Underscores G7, Dots G8)
+)
+
+# Section header lines: first non-blank character is '.', the rest of the line is the section name
+SECTION_RE = re.compile(r'^[^\S\n]*\.(.*)$', re.M)
+# Metadata lookups: {1=key,beats/type} in .keyandmeters and J=<bpm> in .expression
+_KEY_METERS_RE = re.compile(r'\{\s*1=([^,]+)\s*,\s*([^}]+)\s*\}')
+_TEMPO_RE = re.compile(r'J=(\d+)')
+# (accidental_str, is_b_note) -> (alter, MusicXML accidental type), resolved against the key once
+_KEY_HAS_B_FLAT = (KEY_SIGNATURE_FIFTHS == -1) # True for F Major/D minor
+ACCIDENTAL_TABLE = {
+    ('#', True): (0, 'natural') if _KEY_HAS_B_FLAT else (1, 'sharp'),
+    ('#', False): (1, 'sharp'),
+    ('b', True): (-1, 'flat'),
+    ('b', False): (-1, 'flat'),
+    ('', True): (-1, None) if _KEY_HAS_B_FLAT else (0, None), # No explicit accidental
+    ('', False): (0, None),
+}
 
 # --- Helper Functions ---
 
 def pitch_to_musicxml(note_num, accidental_str, octave_str):
     """Converts Jianpu note info to MusicXML pitch elements."""
-    if note_num not in NOTE_MAP_F_MAJOR:
+    idx = ord(note_num) - 48 if len(note_num) == 1 else 0 # '1'..'7' -> 1..7
+    step = STEPS_F_MAJOR[idx] if 0 < idx < 8 else None
+    if step is None:
         print(f"Warning: Unknown note number '{note_num}'")
         return None, None, None, None # Step, Alter, Octave, Accidental Type
-    step, base_octave = NOTE_MAP_F_MAJOR[note_num]
+    base_octave = BASE_OCTAVES_F_MAJOR[idx]
     octave = base_octave + len(octave_str) # Each 'g' adds 1 octave
-    alter = 0
-    accidental_type = None # MusicXML accidental element ('sharp', 'flat', 'natural')
-    is_b_note = (step == 'B')
-    key_has_b_flat = (KEY_SIGNATURE_FIFTHS == -1) # True for F Major/D minor
-    if accidental_str == '#':
-        if is_b_note and key_has_b_flat: alter, accidental_type = 0, 'natural'
-        else: alter, accidental_type = 1, 'sharp'
-    elif accidental_str == 'b': alter, accidental_type = -1, 'flat'
-    else: # No explicit accidental
-        if is_b_note and key_has_b_flat: alter = -1
-        else: alter = 0
+    alter, accidental_type = ACCIDENTAL_TABLE[(accidental_str or '', step == 'B')]
     return step, alter, octave, accidental_type
 
-def duration_to_musicxml(underscores, dots):
-    """Calculates MusicXML duration, type, and dot info from underscores and dots."""
-    base_duration = float(BASE_DURATION_DIVISIONS)
-    # Ensure dots are strings before calling len()
-    dots = dots if dots is not None else ""
-    underscores = underscores if underscores is not None else ""
-
-    num_underscores = len(underscores)
-    num_dots = len(dots)
-    current_duration = base_duration / pow(2, num_underscores)
-    total_duration = current_duration
-    dot_increment = current_duration
-    for _ in range(num_dots):
-        dot_increment /= 2.0
-        total_duration += dot_increment
-    total_duration = int(round(total_duration))
-    type_duration_lookup = int(round(current_duration))
+def _round_shift(value, shift):
+    """Returns value / 2**shift rounded half-to-even (same result as round() on the float)."""
+    if shift <= 0: return value << -shift
+    quotient = value >> shift
+    remainder = value - (quotient << shift); half = 1 << (shift - 1)
+    if remainder > half or (remainder == half and quotient & 1): quotient += 1
+    return quotient
+
+@functools.lru_cache(maxsize=64)
+def _duration_cached(num_underscores, num_dots):
+    """Duration math keyed on (underscore count, dot count); only a handful of distinct inputs occur."""
+    # Pure integer math: with d dots the length is base * (2^(d+1) - 1) / 2^(u+d)
+    total_duration = _round_shift(BASE_DURATION_DIVISIONS * ((2 << num_dots) - 1), num_underscores + num_dots)
+    type_duration_lookup = _round_shift(BASE_DURATION_DIVISIONS, num_underscores)
     note_type = DURATION_MAP.get(type_duration_lookup, 'quarter')
     has_dot = num_dots > 0
     return total_duration, note_type, has_dot, num_dots
 
-def pretty_print_xml(element):
-    """Returns a pretty-printed XML string with declaration."""
-    rough_string = ET.tostring(element, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    return reparsed.toprettyxml(indent="  ", encoding="UTF-8").decode('utf-8')
+# --- XML text templates (the document is written as text, not built as Elements) ---
+XML_HEADER = '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<score-partwise version="4.0">\n'
+NOTE_TEMPLATE = ("      <note>{acc}\n        <pitch>\n          <step>{step}</step>{alter}\n"
+                 "          <octave>{oct}</octave>\n        </pitch>{dur}{extra}\n      </note>\n")
+REST_TEMPLATE = "      <note>\n        <rest />{dur}{extra}\n      </note>\n"
+DURATION_TEMPLATE = "\n        <duration>{d}</duration>\n        <type>{t}</type>{dots}"
+TUPLET_TEMPLATE = ("\n        <time-modification>\n          <actual-notes>{actual}</actual-notes>\n"
+                   "          <normal-notes>{normal}</normal-notes>\n        </time-modification>\n"
+                   '        <notations>\n          <tuplet type="{type}" number="1" bracket="{bracket}" />\n        </notations>')
+# First-measure <attributes>: everything but the time signature is fixed by module constants
+ATTRIBUTES_TEMPLATE = ("      <attributes>\n"
+                       f"        <divisions>{DIVISIONS}</divisions>\n"
+                       f"        <key>\n          <fifths>{KEY_SIGNATURE_FIFTHS}</fifths>\n        </key>\n"
+                       "        <time>\n          <beats>{beats}</beats>\n          <beat-type>{beat_type}</beat-type>\n        </time>\n"
+                       "        <clef>\n          <sign>G</sign>\n          <line>2</line>\n        </clef>\n"
+                       "      </attributes>\n")
+TEMPO_TEMPLATE = ('      <direction placement="above">\n        <direction-type>\n'
+                  '          <metronome parentheses="no">\n            <beat-unit>quarter</beat-unit>\n'
+                  '            <per-minute>{bpm}</per-minute>\n          </metronome>\n        </direction-type>\n'
+                  '        <sound tempo="{bpm}" />\n      </direction>\n')
+WORDS_TEMPLATE = ('      <direction placement="above">\n        <direction-type>\n'
+                  '          <words>{words}</words>\n        </direction-type>\n      </direction>\n')
+DOT_XML = "\n        <dot />"
+_TODAY_ISO = None # Cached <encoding-date> value, filled on first use
+
+@functools.lru_cache(maxsize=64)
+def duration_xml(num_underscores, num_dots):
+    """Rendered <duration>/<type>/<dot/> block for a note's underscore and dot counts, built once per pair."""
+    duration, note_type, has_dot, num_dots = _duration_cached(num_underscores, num_dots)
+    return DURATION_TEMPLATE.format(d=duration, t=note_type, dots=DOT_XML * num_dots)
+
+def note_xml(step, alter, octave, acc_type, dur_xml, extra=""):
+    """Formats one pitched <note> element; extra is appended inside it (e.g. tuplet markings)."""
+    return NOTE_TEMPLATE.format(
+        acc=f"\n        <accidental>{acc_type}</accidental>" if acc_type else "",
+        step=step, alter=f"\n          <alter>{alter}</alter>" if alter else "",
+        oct=octave, dur=dur_xml, extra=extra)
+
+def rest_xml(dur_xml, extra=""):
+    """Formats one rest <note> element."""
+    return REST_TEMPLATE.format(dur=dur_xml, extra=extra)
 
 def parse_jpwabc(jpwabc_content):
     """Parses the JPW-ABC content into a dictionary."""
     data = {'metadata': {}, 'options': {}, 'voice_measures': []} # Initialize voice_measures as list
-    current_section = None
-    voice_buffer = ""
-    lines = jpwabc_content.splitlines()
-    for line in lines:
-        line = line.strip()
-        if not line or line.startswith('//'): continue
-        if line.startswith('.'):
-            if current_section == 'voice' and voice_buffer:
-                 measures_raw = [m.strip() for m in voice_buffer.split('|') if m.strip()]
-                 if measures_raw: data['voice_measures'].extend(measures_raw) # Use extend to add multiple measures
-                 voice_buffer = ""
-            section_name = line[1:].lower().strip()
-            current_section = section_name
-            if current_section not in data and current_section != 'voice': data[current_section] = {}
+    # Rejoin on '\n' so every splitlines() boundary (bare '\r' included) ends a line for SECTION_RE
+    # Split yields [preamble, name1, body1, name2, body2, ...]; text before the first section is ignored
+    chunks = SECTION_RE.split("\n".join(jpwabc_content.splitlines()))
+    for i in range(1, len(chunks), 2):
+        section_name = chunks[i].strip().lower()
+        lines = [line for line in (raw.strip() for raw in chunks[i + 1].split('\n'))
+                 if line and not line.startswith('//')]
+        if section_name == 'voice':
+            # Voice lines are concatenated as-is, then cut into measures at the bar lines
+            data['voice_measures'].extend(m.strip() for m in "".join(lines).split('|') if m.strip())
             continue
-        if current_section == 'options':
-            if '=' in line: key, value = line.split('=', 1); data['options'][key.strip()] = value.strip()
-        elif current_section == 'title':
-             if '=' in line: key, value = line.split('=', 1); data['metadata'][key.strip().replace(' ', '').lower()] = value.strip()
-        elif current_section == 'voice': voice_buffer += line
-    if current_section == 'voice' and voice_buffer:
-        measures_raw = [m.strip() for m in voice_buffer.split('|') if m.strip()]
-        if measures_raw: data['voice_measures'].extend(measures_raw) # Use extend for final buffer processing
+        if section_name not in data: data[section_name] = {}
+        pairs = [line.split('=', 1) for line in lines if '=' in line]
+        if section_name == 'options':
+            data['options'].update((key.strip(), value.strip()) for key, value in pairs)
+        elif section_name == 'title':
+            data['metadata'].update((key.strip().replace(' ', '').lower(), value.strip()) for key, value in pairs)
     return data
 
 
 # --- create_musicxml function (CORRECTED REGEX and GROUP ACCESS) ---
 def create_musicxml(parsed_data):
+    """Builds the MusicXML document as a string (written directly, no Element tree)."""
     # Level 1 Indentation
     if not parsed_data or not parsed_data.get('voice_measures'):
         print("Error: No voice data found to convert.")
         return None
 
-    score_partwise = ET.Element("score-partwise", version="4.0")
+    md = parsed_data.get('metadata', {})
+    buf = io.StringIO()
+    write = buf.write
+    write(XML_HEADER)
 
     # --- Metadata ---
-    work_title_text = parsed_data['metadata'].get('title', 'Untitled')
-    work = ET.SubElement(score_partwise, "work")
-    ET.SubElement(work, "work-title").text = work_title_text
-
-    identification = ET.SubElement(score_partwise, "identification")
-    encoding = ET.SubElement(identification, "encoding")
-    ET.SubElement(encoding, "software").text = "JPW-ABC to MusicXML Converter (Python)"
-    ET.SubElement(encoding, "encoding-date").text = datetime.date.today().isoformat()
-    composer = parsed_data['metadata'].get('wordsbyandmusicby', '')
+    work_title_text = escape(md.get('title', 'Untitled'))
+    write(f"  <work>\n    <work-title>{work_title_text}</work-title>\n  </work>\n")
+
+    global _TODAY_ISO
+    if _TODAY_ISO is None: # Resolve the encoding date once per process (batch conversions reuse it)
+        import datetime # Imported here so library use does not pay for it
+        _TODAY_ISO = datetime.date.today().isoformat()
+    write("  <identification>\n    <encoding>\n"
+          "      <software>JPW-ABC to MusicXML Converter (Python)</software>\n"
+          f"      <encoding-date>{_TODAY_ISO}</encoding-date>\n    </encoding>\n")
+    composer = md.get('wordsbyandmusicby', '')
     if composer:
         parts = composer.split(':') if ':' in composer else composer.split('/')
         creator_type = "composer"; name = composer.strip()
@@ -133,176 +187,99 @@ def create_musicxml(parsed_data):
             if "music" in role_low: creator_type="composer"
             elif "lyrics" in role_low: creator_type="lyricist"
             elif "arranger" in role_low: creator_type="arranger"
-        ET.SubElement(identification, "creator", type=creator_type).text = name
+        write(f'    <creator type="{creator_type}">{escape(name)}</creator>\n')
+    write("  </identification>\n")
 
     # --- Part List ---
-    part_list = ET.SubElement(score_partwise, "part-list")
-    score_part = ET.SubElement(part_list, "score-part", id="P1")
-    ET.SubElement(score_part, "part-name").text = work_title_text
+    write(f'  <part-list>\n    <score-part id="P1">\n      <part-name>{work_title_text}</part-name>\n'
+          '    </score-part>\n  </part-list>\n')
 
     # --- Part Data ---
-    part = ET.SubElement(score_partwise, "part", id="P1")
+    write('  <part id="P1">\n')
 
     measure_number = 0
     time_signature_str = "4/4"; key_sig_str = "F"
-    key_meters_match = re.search(r'\{\s*1=([^,]+)\s*,\s*([^}]+)\s*\}', parsed_data['metadata'].get('keyandmeters', ''))
+    key_meters_match = _KEY_METERS_RE.search(md.get('keyandmeters', ''))
     if key_meters_match: key_sig_str = key_meters_match.group(1).strip(); time_signature_str = key_meters_match.group(2).strip()
-    tempo_bpm = None; tempo_match = re.search(r'J=(\d+)', parsed_data['metadata'].get('expression', ''))
+    tempo_bpm = None; tempo_match = _TEMPO_RE.search(md.get('expression', ''))
     if tempo_match: tempo_bpm = int(tempo_match.group(1))
 
-    # CORRECTED Regular Expression: Handles note/rest + underscore + dot order, and tuplet structure
-    note_pattern = re.compile(
-        r"([#b]?)([1-7])(g*) (_*) (\.*)" +      # Note Grp 1-5 (Underscores G4, Dots G5)
-        r"|(\{ \( (\d+) \} (.*?) \))" +          # Tuplet Grp 6(Marker G7 (\d+), Content G8) -> Note: G7 is digit only
-        r"|(\$\( (.*?) \))" +                  # Directive Grp 9(Content G10)
-        r"|(0) (_*) (\.*)",                    # Rest Grp 11(Underscores G12, Dots G13)
-        re.VERBOSE                            # Use VERBOSE for clarity
-    )
-
-
     # Level 1 Indentation for the loop
     for measure_str in parsed_data.get('voice_measures', []):
         # Level 2 Indentation
         measure_number += 1
-        measure = ET.SubElement(part, "measure", number=str(measure_number))
+        write(f'    <measure number="{measure_number}">\n')
 
         # Add attributes (key, time, clef) to the first measure
         if measure_number == 1:
-            attributes = ET.SubElement(measure, "attributes")
-            ET.SubElement(attributes, "divisions").text = str(DIVISIONS)
-            key = ET.SubElement(attributes, "key")
-            ET.SubElement(key, "fifths").text = str(KEY_SIGNATURE_FIFTHS)
-            time = ET.SubElement(attributes, "time")
             if time_signature_str and '/' in time_signature_str:
                 beats, beat_type = time_signature_str.split('/')
-                ET.SubElement(time, "beats").text = beats; ET.SubElement(time, "beat-type").text = beat_type
             else:
-                ET.SubElement(time, "beats").text = "4"; ET.SubElement(time, "beat-type").text = "4"
-            clef = ET.SubElement(attributes, "clef")
-            ET.SubElement(clef, "sign").text = "G"; ET.SubElement(clef, "line").text = "2"
+                beats, beat_type = "4", "4"
+            write(ATTRIBUTES_TEMPLATE.format(beats=escape(beats), beat_type=escape(beat_type)))
             if tempo_bpm:
-                direction = ET.SubElement(measure, "direction", placement="above")
-                direction_type = ET.SubElement(direction, "direction-type")
-                metronome = ET.SubElement(direction_type, "metronome", parentheses="no")
-                ET.SubElement(metronome, "beat-unit").text = "quarter"
-                ET.SubElement(metronome, "per-minute").text = str(tempo_bpm)
-                sound = ET.SubElement(direction, "sound", tempo=str(tempo_bpm))
-
-        # Process elements within the measure string
-        pos = 0
-        while pos < len(measure_str):
-            # Level 3 Indentation
-            match = note_pattern.match(measure_str, pos)
-            if match:
-                # Level 4 Indentation
-                note_added = False
-                # --- Matched a Note (Group 2 has number) ---
-                if match.group(2):
-                    accidental_str = match.group(1)
-                    note_num = match.group(2)
-                    octave_str = match.group(3)
-                    underscores_str = match.group(4) # Group 4 is underscores
-                    dots_str = match.group(5)        # Group 5 is dots
-                    step, alter, octave, acc_type = pitch_to_musicxml(note_num, accidental_str, octave_str)
-                    duration, note_type, has_dot, num_dots = duration_to_musicxml(underscores_str, dots_str)
-                    if step:
-                        note = ET.SubElement(measure, "note"); note_added = True
-                        if acc_type: ET.SubElement(note, "accidental").text = acc_type
-                        pitch = ET.SubElement(note, "pitch"); ET.SubElement(pitch, "step").text = step
-                        if alter is not None and alter != 0: ET.SubElement(pitch, "alter").text = str(alter)
-                        ET.SubElement(pitch, "octave").text = str(octave)
-                        ET.SubElement(note, "duration").text = str(duration)
-                        ET.SubElement(note, "type").text = note_type
-                        for _ in range(num_dots): ET.SubElement(note, "dot")
-
-                # --- Matched a Rest (Group 11 is '0') ---
-                elif match.group(11):
-                    rest_marker = match.group(11)
-                    underscores_str = match.group(12) # Group 12 is underscores
-                    dots_str = match.group(13)        # Group 13 is dots
-                    duration, note_type, has_dot, num_dots = duration_to_musicxml(underscores_str, dots_str)
-                    note = ET.SubElement(measure, "note"); note_added = True
-                    ET.SubElement(note, "rest"); ET.SubElement(note, "duration").text = str(duration); ET.SubElement(note, "type").text = note_type
-                    for _ in range(num_dots): ET.SubElement(note, "dot")
-
-                # --- Matched a Tuplet (Group 6 is the whole match) ---
-                elif match.group(6):
-                    full_tuplet_str = match.group(6)
-                    # Group 7 is the digit inside (\d+)
-                    # Group 8 is the content (.*?)
-                    ratio_digit_str = match.group(7)
-                    tuplet_content = match.group(8)
-                    print(f"Info: Parsing Tuplet: {full_tuplet_str}")
-
-                    actual_notes = 3; normal_notes = 2 # Default triplet
-                    if ratio_digit_str and ratio_digit_str.isdigit():
-                        actual_notes = int(ratio_digit_str)
-                    else:
-                         print(f"Warning: Could not extract ratio digit from tuplet: {full_tuplet_str}")
-
-                    inner_pos = 0
-                    notes_in_tuplet_matches = []
-                    while inner_pos < len(tuplet_content):
-                         # Use the same pattern to find notes/rests within the tuplet content
-                         inner_match = note_pattern.match(tuplet_content, inner_pos)
-                         if inner_match: notes_in_tuplet_matches.append(inner_match); inner_pos = inner_match.end()
-                         elif not tuplet_content[inner_pos].isspace(): inner_pos += 1 # Skip unknown non-space chars
-                         else: inner_pos += 1 # Skip whitespace
-
-                    for i, inner_match in enumerate(notes_in_tuplet_matches):
-                        is_first = (i == 0); is_last = (i == len(notes_in_tuplet_matches) - 1)
-                        tuplet_note = None
-                        if inner_match.group(2): # Inner Note
-                            # Indices 0-4 -> Groups 1-5 of the inner match
-                            acc_inner, num_inner, oct_inner, under_inner, dot_inner = inner_match.groups()[0:5]
-                            step, alter, octave, acc_type = pitch_to_musicxml(num_inner, acc_inner, oct_inner)
-                            duration, note_type, has_dot, num_dots = duration_to_musicxml(under_inner, dot_inner)
-                            if step:
-                                tuplet_note = ET.SubElement(measure, "note")
-                                if acc_type: ET.SubElement(tuplet_note, "accidental").text = acc_type
-                                pitch = ET.SubElement(tuplet_note, "pitch"); ET.SubElement(pitch, "step").text = step
-                                if alter is not None and alter != 0: ET.SubElement(pitch, "alter").text = str(alter)
-                                ET.SubElement(pitch, "octave").text = str(octave)
-                                ET.SubElement(tuplet_note, "duration").text = str(duration); ET.SubElement(tuplet_note, "type").text = note_type
-                                for _ in range(num_dots): ET.SubElement(tuplet_note, "dot")
-                        elif inner_match.group(11): # Inner Rest
-                             # Indices 10-12 -> Groups 11-13 of the inner match
-                             rest_marker_inner, under_inner, dot_inner = inner_match.groups()[10:13]
-                             duration, note_type, has_dot, num_dots = duration_to_musicxml(under_inner, dot_inner)
-                             tuplet_note = ET.SubElement(measure, "note"); ET.SubElement(tuplet_note, "rest")
-                             ET.SubElement(tuplet_note, "duration").text = str(duration); ET.SubElement(tuplet_note, "type").text = note_type
-                             for _ in range(num_dots): ET.SubElement(tuplet_note, "dot")
-                        else: continue
-                        # Add tuplet markings if a note/rest was created
-                        if tuplet_note is not None:
-                            note_added = True
-                            tm = ET.SubElement(tuplet_note, "time-modification"); ET.SubElement(tm, "actual-notes").text = str(actual_notes); ET.SubElement(tm, "normal-notes").text = str(normal_notes)
-                            notations = ET.SubElement(tuplet_note, "notations"); tuplet_type = "start" if is_first else ("stop" if is_last else "continue"); bracket_val = "yes" if is_first else "no"
-                            ET.SubElement(notations, "tuplet", type=tuplet_type, number="1", bracket=bracket_val)
-
-                # --- Matched a Directive (Group 9 is the whole match) ---
-                elif match.group(9):
-                     full_directive_str = match.group(9)
-                     directive_content = match.group(10) # Content is Group 10
-                     print(f"Info: Found directive: $({directive_content}) - adding as text direction.")
-                     direction = ET.SubElement(measure, "direction", placement="above"); direction_type = ET.SubElement(direction, "direction-type"); ET.SubElement(direction_type, "words").text = f"$({directive_content})"
-
-                # --- Advance Position ---
-                pos = match.end()
+                write(TEMPO_TEMPLATE.format(bpm=tempo_bpm))
 
-            else:
-                # No match, potentially whitespace or unrecognized char, skip it
-                if pos < len(measure_str) and not measure_str[pos].isspace():
-                     # print(f"Warning: Skipping unrecognized character '{measure_str[pos]}' in measure {measure_number} at pos {pos}")
-                     pass # Silently skip for now
-                pos += 1
+        # Tokenize the whole measure in one C-level pass: each token is the flat tuple of NOTE_PATTERN groups
+        # (the scan skips whitespace and unrecognized characters)
+        for (accidental_str, note_num, octave_str, underscores_str, dots_str,
+             full_tuplet_str, ratio_digit_str, tuplet_content, full_directive_str, directive_content,
+             rest_marker, rest_underscores_str, rest_dots_str) in NOTE_PATTERN.findall(measure_str):
+            # Level 3 Indentation
+            # --- Matched a Note (Group 2 has number) ---
+            if note_num:
+                step, alter, octave, acc_type = pitch_to_musicxml(note_num, accidental_str, octave_str)
+                if step:
+                    write(note_xml(step, alter, octave, acc_type, duration_xml(len(underscores_str), len(dots_str))))
+
+            # --- Matched a Rest (Group 11 is '0') ---
+            elif rest_marker:
+                write(rest_xml(duration_xml(len(rest_underscores_str), len(rest_dots_str))))
+
+            # --- Matched a Tuplet (Group 6 is the whole match; G7 ratio digit, G8 content) ---
+            elif full_tuplet_str:
+                print(f"Info: Parsing Tuplet: {full_tuplet_str}")
+
+                actual_notes = 3; normal_notes = 2 # Default triplet
+                if ratio_digit_str and ratio_digit_str.isdigit():
+                    actual_notes = int(ratio_digit_str)
+                else:
+                     print(f"Warning: Could not extract ratio digit from tuplet: {full_tuplet_str}")
+
+                # Find notes/rests within the tuplet content
+                tuplet_tokens = TUPLET_NOTE_PATTERN.findall(tuplet_content)
+
+                for i, inner in enumerate(tuplet_tokens):
+                    is_first = (i == 0); is_last = (i == len(tuplet_tokens) - 1)
+                    # Tuplet markings follow the note/rest body
+                    tuplet_type = "start" if is_first else ("stop" if is_last else "continue"); bracket_val = "yes" if is_first else "no"
+                    tuplet_xml = TUPLET_TEMPLATE.format(actual=actual_notes, normal=normal_notes, type=tuplet_type, bracket=bracket_val)
+                    if inner[1]: # Inner Note
+                        # Indices 0-4 -> Groups 1-5 of the inner match
+                        acc_inner, num_inner, oct_inner, under_inner, dot_inner = inner[0:5]
+                        step, alter, octave, acc_type = pitch_to_musicxml(num_inner, acc_inner, oct_inner)
+                        if step:
+                            write(note_xml(step, alter, octave, acc_type, duration_xml(len(under_inner), len(dot_inner)), tuplet_xml))
+                    else: # Inner Rest
+                         # Indices 6-7 -> Groups 7-8 of the inner match (Group 6 is the '0' marker)
+                         under_inner, dot_inner = inner[6:8]
+                         write(rest_xml(duration_xml(len(under_inner), len(dot_inner)), tuplet_xml))
+
+            # --- Matched a Directive (Group 9 is the whole match; content is Group 10) ---
+            elif full_directive_str:
+                 print(f"Info: Found directive: $({directive_content}) - adding as text direction.")
+                 write(WORDS_TEMPLATE.format(words=escape(f"$({directive_content})")))
+
+        write("    </measure>\n")
 
     # Level 1 Indentation
-    return score_partwise
+    write("  </part>\n</score-partwise>")
+    return buf.getvalue()
 
 
 # --- Execution ---
 if __name__ == "__main__": # Standard practice for executable scripts
+    import argparse # For command-line arguments
     parser = argparse.ArgumentParser(description='Convert JPW-ABC file to MusicXML.')
     parser.add_argument('-f', '--file', required=True, help='Input JPW-ABC file path.')
     parser.add_argument('-t', '--target', required=True, help='Output MusicXML file path.')
@@ -312,31 +289,28 @@ if __name__ == "__main__": # Standard practice for executable scripts
     output_filepath = args.target
     jpwabc_input_content = None
 
-    # --- UPDATED File Reading with Encoding Fallback ---
+    # --- File Reading: read bytes once, pick the codec from the BOM ---
     try:
-        # Try reading with utf-16 first (handles BOM FF FE or FE FF)
-        with open(input_filepath, 'r', encoding='utf-16') as f_in:
-             jpwabc_input_content = f_in.read()
-        print(f"Read input from: {input_filepath} (using utf-16)")
+        with open(input_filepath, 'rb') as f_in:
+            raw_input = f_in.read()
     except FileNotFoundError:
         print(f"Error: Input file not found: {input_filepath}")
         exit(1)
-    except UnicodeDecodeError:
-        # Fallback if utf-16 failed (maybe it's utf-8 with BOM or other)
-        print(f"Warning: Failed to read {input_filepath} as utf-16. Trying utf-8-sig...")
-        try:
-            # Try utf-8-sig (handles utf-8 with BOM EF BB BF)
-            with open(input_filepath, 'r', encoding='utf-8-sig') as f_in:
-                jpwabc_input_content = f_in.read()
-            print(f"Read input from: {input_filepath} (using utf-8-sig)")
-        except Exception as e_fallback:
-            # If all known encodings fail, report error
-            print(f"Error reading input file {input_filepath} with fallback encodings. Please check file encoding. Error: {e_fallback}")
-            exit(1)
     except Exception as e:
         # Catch other potential errors during file reading
         print(f"Error reading input file {input_filepath}: {e}")
         exit(1)
+
+    if raw_input[:2] in (b'\xff\xfe', b'\xfe\xff'): input_encoding = 'utf-16' # BOM FF FE or FE FF
+    elif raw_input[:3] == b'\xef\xbb\xbf': input_encoding = 'utf-8-sig' # utf-8 with BOM EF BB BF
+    elif b'\x00' in raw_input[:64]: input_encoding = 'utf-16-be' if raw_input[:1] == b'\x00' else 'utf-16-le' # BOM-less UTF-16: ASCII text has a NUL in every other byte
+    else: input_encoding = 'utf-8'
+    try:
+        jpwabc_input_content = raw_input.decode(input_encoding)
+        print(f"Read input from: {input_filepath} (using {input_encoding})")
+    except UnicodeDecodeError as e_decode:
+        print(f"Error reading input file {input_filepath} as {input_encoding}. Please check file encoding. Error: {e_decode}")
+        exit(1)
     # --- End UPDATED File Reading ---
 
     if jpwabc_input_content is None:
@@ -346,17 +320,15 @@ if __name__ == "__main__": # Standard practice for executable scripts
     # 1. Parse the JPW-ABC data
     parsed_jpw_data = parse_jpwabc(jpwabc_input_content)
 
-    # 2. Create the MusicXML structure
-    musicxml_element = create_musicxml(parsed_jpw_data)
-
-    # 3. Generate the XML string and save to file
-    if musicxml_element is not None:
-        xml_output_string = pretty_print_xml(musicxml_element)
+    # 2. Create the MusicXML document text
+    xml_output_string = create_musicxml(parsed_jpw_data)
 
+    # 3. Save to file
+    if xml_output_string is not None:
         try:
-            # Always write output as standard UTF-8
-            with open(output_filepath, "w", encoding="utf-8") as f_out:
-                f_out.write(xml_output_string)
+            # Always write output as standard UTF-8: encode once, write the bytes in a single call
+            with open(output_filepath, "wb") as f_out:
+                f_out.write(xml_output_string.encode("utf-8"))
             print(f"\nSuccessfully saved MusicXML to: {output_filepath}")
 
         except IOError as e:
@@ -365,4 +337,4 @@ if __name__ == "__main__": # Standard practice for executable scripts
             print(f"\nAn unexpected error occurred during file writing: {e}")
 
     else:
-        print("Failed to generate MusicXML structure.")
\ No newline at end of file
+        print("Failed to generate MusicXML document.")
\ No newline at end of file
@@ -1,225 +1,337 @@
-import xml.etree.ElementTree as ET
+try:
+    import lxml.etree as ET # libxml2-backed parse/serialize when available (same Element API)
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET # Source-only fallback
+    HAVE_LXML = False
 import sys
 import argparse
 import os
+from xml.sax.saxutils import escape
+from safe_output import replace_on_success # Temp file + os.replace, shared with jpw2xml
 
 # --- Reusable helper functions (create_defaults_element, find_defaults_insert_index, safe_remove_child) ---
 # (Keep these functions exactly as they were)
+# Static subtrees, parsed in one C-level fromstring call instead of built element by element
+_DEFAULTS_XML = ('<defaults><scaling><millimeters>6.99911</millimeters><tenths>40</tenths></scaling>'
+                 '<page-layout><page-height>1696.94</page-height><page-width>1200.48</page-width>'
+                 '<page-margins type="even"><left-margin>85.7252</left-margin><right-margin>85.7252</right-margin>'
+                 '<top-margin>85.7252</top-margin><bottom-margin>85.7252</bottom-margin></page-margins>'
+                 '<page-margins type="odd"><left-margin>85.7252</left-margin><right-margin>85.7252</right-margin>'
+                 '<top-margin>85.7252</top-margin><bottom-margin>85.7252</bottom-margin></page-margins></page-layout>'
+                 '<appearance><line-width type="staff">1.1</line-width><line-width type="light barline">1.8</line-width>'
+                 '<line-width type="heavy barline">5.5</line-width><line-width type="stem">1</line-width>'
+                 '<line-width type="beam">5</line-width><note-size type="grace">70</note-size></appearance>'
+                 '<music-font font-family="Maestro" font-size="20.4"/><word-font font-family="Times New Roman" font-size="10"/>'
+                 '<lyric-font font-family="Times New Roman" font-size="10"/></defaults>')
+_PRINT_XML = ('<print><system-layout><system-margins><left-margin>50</left-margin><right-margin>0</right-margin></system-margins>'
+              '<top-system-distance>70</top-system-distance></system-layout></print>')
+_TEMPO_DIRECTION_XML = ('<direction placement="above"><direction-type><metronome parentheses="no"><beat-unit>quarter</beat-unit>'
+                        '<per-minute>120</per-minute></metronome></direction-type><sound tempo="120"/></direction>')
+# Rebuilt Measure 1 <attributes>; fields are XML-escaped text read from the original measure
+_ATTRIBUTES_XML_TEMPLATE = ('<attributes><divisions>{divisions}</divisions><key><fifths>{fifths}</fifths><mode>{mode}</mode></key>'
+                            '<time><beats>{beats}</beats><beat-type>{beat_type}</beat-type></time>'
+                            '<clef><sign>{clef_sign}</sign><line>{clef_line}</line></clef></attributes>')
+
 def create_defaults_element():
     """ Creates standard <defaults> element. """
-    defaults = ET.Element('defaults')
-    scaling = ET.SubElement(defaults, 'scaling')
-    ET.SubElement(scaling, 'millimeters').text = '6.99911'; ET.SubElement(scaling, 'tenths').text = '40'
-    page_layout = ET.SubElement(defaults, 'page-layout')
-    ET.SubElement(page_layout, 'page-height').text = '1696.94'; ET.SubElement(page_layout, 'page-width').text = '1200.48'
-    margins_even = ET.SubElement(page_layout, 'page-margins', {'type': 'even'})
-    ET.SubElement(margins_even, 'left-margin').text = '85.7252'; ET.SubElement(margins_even, 'right-margin').text = '85.7252'
-    ET.SubElement(margins_even, 'top-margin').text = '85.7252'; ET.SubElement(margins_even, 'bottom-margin').text = '85.7252'
-    margins_odd = ET.SubElement(page_layout, 'page-margins', {'type': 'odd'})
-    ET.SubElement(margins_odd, 'left-margin').text = '85.7252'; ET.SubElement(margins_odd, 'right-margin').text = '85.7252'
-    ET.SubElement(margins_odd, 'top-margin').text = '85.7252'; ET.SubElement(margins_odd, 'bottom-margin').text = '85.7252'
-    appearance = ET.SubElement(defaults, 'appearance')
-    ET.SubElement(appearance, 'line-width', {'type': 'staff'}).text = '1.1'; ET.SubElement(appearance, 'line-width', {'type': 'light barline'}).text = '1.8'
-    ET.SubElement(appearance, 'line-width', {'type': 'heavy barline'}).text = '5.5'; ET.SubElement(appearance, 'line-width', {'type': 'stem'}).text = '1'
-    ET.SubElement(appearance, 'line-width', {'type': 'beam'}).text = '5'; ET.SubElement(appearance, 'note-size', {'type': 'grace'}).text = '70'
-    ET.SubElement(defaults, 'music-font', {'font-family': 'Maestro', 'font-size': '20.4'})
-    ET.SubElement(defaults, 'word-font', {'font-family': 'Times New Roman', 'font-size': '10'})
-    ET.SubElement(defaults, 'lyric-font', {'font-family': 'Times New Roman', 'font-size': '10'})
-    return defaults
+    return ET.fromstring(_DEFAULTS_XML)
 
 def find_defaults_insert_index(root):
     """ Finds index after <identification> for inserting <defaults>. """
-    identification_idx = -1
-    for i, child in enumerate(list(root)):
-        if child.tag == 'identification': identification_idx = i; break
-    return identification_idx + 1 if identification_idx != -1 else (1 if len(list(root)) > 0 else 0)
+    for i, child in enumerate(root): # Iterate the children directly; stops at <identification>
+        if child.tag == 'identification': return i + 1
+    return 1 if len(root) else 0
 
 def safe_remove_child(parent, child):
     """ Removes child from parent only if it's a direct child. """
     if parent is None or child is None: return False
-    try: list(parent).index(child); parent.remove(child); return True
-    except (ValueError, Exception): return False
+    if HAVE_LXML: # O(1) parent pointer check instead of scanning the siblings
+        if child.getparent() is not parent: return False
+        parent.remove(child); return True
+    try: parent.remove(child); return True # stdlib remove() raises ValueError for a non-child
+    except ValueError: return False
+
+def compile_path(path, text=False):
+    """ Compiled lookup: an lxml XPath object, or a findall/findtext call of the same shape on the stdlib. """
+    if HAVE_LXML: return ET.XPath(f'string({path})' if text else path) # string() hands back a str ('' if absent)
+    if text: return lambda elem: elem.findtext(path, '') # ElementPath caches its compiled paths internally
+    return lambda elem: elem.findall(path)
 # --- End Helper Functions ---
 
-# --- Main Processing Function ---
-
-def fix_transpose_key_rebuild_measure1(input_file, output_file):
+# Metadata element tag -> offset attributes stripped from it during the parse
+_METADATA_STRIP = {'movement-title': ('relative-x', 'relative-y'),
+                   'creator': ('relative-x', 'relative-y'),
+                   'rights': ('relative-x', 'relative-y')}
+_METADATA_TAGS = tuple(_METADATA_STRIP)
+# Stems point down from the middle line up: every octave above 4, and these steps within octave 4
+_STEM_DOWN_STEPS_OCT4 = frozenset({'B'})
+# Level-1 beam label for each position of the fixed 2-4 beam group (SubElement copies the attrib dict)
+_BEAM_LABELS = {1: 'begin', 2: 'continue', 3: 'end'}; _BEAM_ATTRIB = {'number': '1'}
+# Measure 1 lookups, compiled once at import (node paths return lists, text paths return str)
+_XP_PART1 = compile_path('.//part[@id="P1"]'); _XP_M1 = compile_path('./measure[@number="1"]')
+_XP_KEY = compile_path('.//key'); _XP_DIV = compile_path('.//divisions', text=True)
+_XP_BEATS = compile_path('.//time/beats', text=True); _XP_BEAT_TYPE = compile_path('.//time/beat-type', text=True)
+_XP_CLEF_SIGN = compile_path('.//clef/sign', text=True); _XP_CLEF_LINE = compile_path('.//clef/line', text=True)
+_XP_STEP = compile_path('step', text=True); _XP_OCTAVE = compile_path('octave', text=True)
+_OCTAVE_VALUES = {str(octave): octave for octave in range(10)} # MusicXML octaves are 0-9; anything else goes through int()
+
+# --- Main Processing Steps ---
+
+def strip_metadata_offsets(element):
+    """ Pops the offset attributes listed for a metadata element's tag; returns how many were removed. """
+    names = _METADATA_STRIP.get(element.tag)
+    if not names: return 0
+    attrib = element.attrib
+    return sum(attrib.pop(name, None) is not None for name in names)
+
+def apply_general_fixes(root, log=print):
+    """ Score-header fixes: misplaced <description>/<movement-subtitle>, empty <encoding-date>, version 4.0, <defaults>. """
+    log("  Applying general fixes...")
+    identification_element = root.find('identification')
+    if identification_element is not None:
+        desc = identification_element.find('description');
+        if desc is not None and safe_remove_child(identification_element, desc): pass # print("    Removed misplaced <description>.")
+        encoding_element = identification_element.find('encoding')
+        if encoding_element is not None:
+            enc_date = encoding_element.find('encoding-date')
+            if enc_date is not None and (not enc_date.text or not enc_date.text.strip()):
+                if safe_remove_child(encoding_element, enc_date): pass # print("    Removed empty <encoding-date>.")
+    # else: print("    Warning: <identification> section not found.")
+
+    subtitle = root.find('movement-subtitle');
+    if subtitle is not None and safe_remove_child(root, subtitle): pass # print("    Removed misplaced <movement-subtitle>.")
+
+    root.set('version', '4.0'); # print("    Set score-partwise version to 4.0.")
+
+    if root.find('defaults') is None:
+        defaults_element = create_defaults_element(); insert_idx = find_defaults_insert_index(root)
+        root.insert(insert_idx, defaults_element); log(f"    Injected <defaults> section.")
+    # else: print("    <defaults> section already exists.")
+    log("  General fixes applied.")
+
+def rebuild_measure1(measure1, log=print):
+    """
+    Rebuilds Measure 1 in place from its READ musical data with the key signature TRANSPOSED UP one step.
+    Returns (transposed fifths text, key mode).
+    """
+    # --- Store original Measure 1 data ---
+    original_attributes_elem = measure1.find('attributes')
+    original_notes_elems = list(measure1.findall('note'))
+    original_left_barline = measure1.find('barline[@location="left"]')
+    original_right_barline = measure1.find('barline[@location="right"]')
+
+    if original_attributes_elem is None: raise ValueError("Measure 1 is missing <attributes>")
+
+    # --- Read original attributes AND CALCULATE TRANSPOSED KEY ---
+    original_key_elem = next(iter(_XP_KEY(original_attributes_elem)), None)
+    original_fifths_text = "-2" # Default for Bb Major if missing
+    original_key_mode = 'major' # Default mode
+    if original_key_elem is not None:
+        original_fifths_text = original_key_elem.findtext('fifths', original_fifths_text)
+        original_key_mode = original_key_elem.findtext('mode', original_key_mode)
+    else: log("    Warning: <key> element not found. Assuming original Bb Major (-2).")
+
+    transposed_key_fifths = original_fifths_text # Default to original if conversion fails
+    try:
+        original_fifths_val = int(original_fifths_text)
+        transposed_fifths_val = original_fifths_val + 1 # TRANSPOSE UP!
+        transposed_key_fifths = str(transposed_fifths_val)
+        log(f"    Transposing Key Signature: Original fifths={original_fifths_val} -> New fifths={transposed_fifths_val} ({original_key_mode})")
+    except ValueError:
+        log(f"    Warning: Could not parse original fifths value '{original_fifths_text}'. Key signature not transposed.")
+
+    # Read other necessary attributes
+    original_divisions = _XP_DIV(original_attributes_elem) or '128'
+    original_time_beats = _XP_BEATS(original_attributes_elem) or '4'
+    original_time_beat_type = _XP_BEAT_TYPE(original_attributes_elem) or '4'
+    original_clef_sign = _XP_CLEF_SIGN(original_attributes_elem) or 'G'
+    original_clef_line = _XP_CLEF_LINE(original_attributes_elem) or '2'
+    # --- End Reading Attributes ---
+
+
+    # --- Read original notes data (parallel lists, one row per valid note/rest) ---
+    note_elems = []; pitch_elems = []; rest_elems = []; duration_elems = []; type_elems = []
+    # print("    Reading original notes from Measure 1...") # Less verbose
+    for old_note in original_notes_elems:
+         pitch = old_note.find('pitch'); rest = old_note.find('rest') if pitch is None else None
+         if pitch is not None or rest is not None:
+              duration = old_note.find('duration'); note_type = old_note.find('type')
+              if duration is not None and note_type is not None:
+                   note_elems.append(old_note); pitch_elems.append(pitch); rest_elems.append(rest)
+                   duration_elems.append(duration); type_elems.append(note_type)
+    # print(f"    Read {len(type_elems)} valid note/rest elements.")
+
+
+    # --- Clear and Reconstruct Measure ---
+    # print("    Clearing original Measure 1 content...") # Less verbose
+    measure1.clear(); measure1.set('number', '1')
+    if original_left_barline is not None: measure1.append(original_left_barline)
+
+    # --- Add Reconstructed <attributes> using TRANSPOSED key ---
+    # print("    Adding reconstructed <attributes>...") # Less verbose
+    attributes_rebuilt = ET.fromstring(_ATTRIBUTES_XML_TEMPLATE.format(
+        divisions=escape(original_divisions), fifths=escape(transposed_key_fifths), # USE TRANSPOSED VALUE
+        mode=escape(original_key_mode), # Keep original mode
+        beats=escape(original_time_beats), beat_type=escape(original_time_beat_type),
+        clef_sign=escape(original_clef_sign), clef_line=escape(original_clef_line)))
+    measure1.append(attributes_rebuilt)
+
+    # --- Add <print> element ---
+    # print("    Adding <print> element...") # Less verbose
+    print_elem = ET.fromstring(_PRINT_XML)
+    measure1.append(print_elem)
+
+    # --- Add reconstructed <direction> for tempo ---
+    # print("    Adding reconstructed <direction> with tempo...") # Less verbose
+    direction_elem = ET.fromstring(_TEMPO_DIRECTION_XML)
+    measure1.append(direction_elem)
+
+    # --- Re-add notes using READ data (same logic as before) ---
+    # print("    Re-adding notes using READ original data and reference structure...") # Less verbose
+    note_counter = 0; beam_level_1_state = None
+    # Notes 2-4 are beamed when they are three eighth notes (every stored entry has a <type>; a rest breaks the group)
+    beamable_indices = set()
+    if [t.text for t in type_elems[1:4]] == ['eighth', 'eighth', 'eighth'] and None not in pitch_elems[1:4]:
+          beamable_indices = {1, 2, 3}
+
+    # Each kept <note> is emptied and refilled in place rather than replaced by a freshly allocated element
+    SubElement = ET.SubElement # Bound once for the per-note loop
+    for i, (new_note, pitch_elem, rest_elem, duration_elem, type_elem) in enumerate(
+            zip(note_elems, pitch_elems, rest_elems, duration_elems, type_elems)):
+        new_note.clear() # Drops attributes, text/tail and the children that are not re-added (lyrics, notations, ...)
+        if rest_elem is not None:
+            new_note.append(rest_elem); beam_level_1_state = None
+        elif pitch_elem is not None:
+            new_note.append(pitch_elem)
+            SubElement(new_note, 'voice').text = '1'
+            step = _XP_STEP(pitch_elem); octave_text = _XP_OCTAVE(pitch_elem) or '4'
+            octave = _OCTAVE_VALUES[octave_text] if octave_text in _OCTAVE_VALUES else int(octave_text)
+            stem_dir = 'down' if octave > 4 or (octave == 4 and step in _STEM_DOWN_STEPS_OCT4) else 'up' # Adjusted stem logic slightly
+            SubElement(new_note, 'stem').text = stem_dir
+            if i in beamable_indices:
+                 beam_label = _BEAM_LABELS[i]
+                 SubElement(new_note, 'beam', _BEAM_ATTRIB).text = beam_label
+                 beam_level_1_state = None if beam_label == 'end' else beam_label
+            else: beam_level_1_state = None
+        new_note.append(duration_elem); new_note.append(type_elem)
+        measure1.append(new_note)
+        note_counter += 1
+    # print(f"    Re-added {note_counter} notes to Measure 1 from read data.")
+
+    if original_right_barline is not None: measure1.append(original_right_barline)
+    log("  Measure 1 rebuild complete.")
+    return transposed_key_fifths, original_key_mode
+
+def _iter_part_measures(context, part_ids):
+    """ Yields each <part>/<measure> as it closes; metadata elements are cleaned and <part> ids collected on the way past. """
+    for _event, element in context:
+        if element.tag == 'measure':
+            if element.getparent().tag == 'part': yield element
+        elif element.tag == 'part': part_ids.add(element.get('id')) # Seen even when the part has no measures
+        else: strip_metadata_offsets(element)
+
+def _flush_children(xf, parent, stop=None, streamed=None):
+    """
+    Detaches and writes (with tails) parent's children ahead of stop, or all of them. For the child that was
+    already streamed only its tail is written. Detaching first keeps inherited xmlns declarations off each node.
+    """
+    while len(parent) and parent[0] is not stop:
+        node = parent[0]; parent.remove(node)
+        if node is not streamed: xf.write(node)
+        elif node.tail: xf.write(node.tail)
+
+def _stream_score(xf, root, measure, measures, log):
+    """ Writes the score into xmlfile xf, rebuilding P1's Measure 1 on the way; returns the rebuild result (None if not found). """
+    result = None; measure1 = None
+    xf.write_declaration()
+    doctype = root.getroottree().docinfo.doctype
+    if doctype: xf.write_doctype(doctype)
+    for node in reversed(list(root.itersiblings(preceding=True))): xf.write(node) # Prolog comments/PIs
+    with xf.element(root.tag, root.attrib, nsmap=root.nsmap):
+        if root.text: xf.write(root.text)
+        part = None
+        while measure is not None:
+            previous_part, part = part, measure.getparent()
+            _flush_children(xf, root, part, streamed=previous_part) # Header, or whatever sits between parts
+            with xf.element(part.tag, part.attrib):
+                if part.text: xf.write(part.text)
+                # A node (and its tail) is only complete once the parser has moved past it, so everything
+                # is written one measure late; that includes the Measure 1 rebuild
+                while measure is not None and measure.getparent() is part:
+                    if measure1 is not None:
+                        log("  Rebuilding Measure 1..."); result = rebuild_measure1(measure1, log); measure1 = None
+                    _flush_children(xf, part, measure)
+                    if result is None and part.get('id') == 'P1' and measure.get('number') == '1': measure1 = measure
+                    measure = next(measures, None)
+                if measure1 is not None:
+                    log("  Rebuilding Measure 1..."); result = rebuild_measure1(measure1, log); measure1 = None
+                _flush_children(xf, part)
+        _flush_children(xf, root, streamed=part)
+    return result
+
+def stream_fix_and_rebuild(input_file, output_file, log=print):
+    """
+    lxml path: streams the score through an incremental writer one measure at a time, so only the
+    score header and the current measure are held in memory. Returns rebuild_measure1()'s result.
+    """
+    # huge_tree lifts libxml2's size limits for big scores; MusicXML has no xml:id lookups, so skip the ID table
+    context = ET.iterparse(input_file, events=('end',), tag=('measure', 'part') + _METADATA_TAGS, huge_tree=True, collect_ids=False)
+    part_ids = set() # Filled in as the parse passes each <part>; complete once the stream has been written
+    measures = _iter_part_measures(context, part_ids)
+    measure = next(measures, None) # By the first measure's end the whole score header has been parsed
+    root = measure.getparent().getparent() if measure is not None else context.root
+
+    log(f"Processing '{input_file}' for Finale (Transposing Key Sig, Rebuilding M1)...")
+    apply_general_fixes(root, log)
+
+    # The input is still being read while the output is written, so the output goes to a temp file first
+    with replace_on_success(output_file, buffering=1 << 20) as f_out: # One large buffered stream for the incremental writer
+        with ET.xmlfile(f_out, encoding='UTF-8') as xf: result = _stream_score(xf, root, measure, measures, log)
+        for node in root.itersiblings(): f_out.write(ET.tostring(node)) # Trailing comments/PIs (xmlfile refuses them)
+        if result is None:
+            raise ValueError("Could not find <measure number='1'> in Part P1" if 'P1' in part_ids else "Could not find <part id='P1'>")
+    return result
+
+def tree_fix_and_rebuild(input_file, output_file, log=print):
+    """ stdlib path: parses the whole score, fixes it in memory and writes it back. Returns rebuild_measure1()'s result. """
+    # --- Parse + general fix 1: strip relative-x/y from metadata as each element closes (one pass, no re-walks) ---
+    context = ET.iterparse(input_file, events=('end',), parser=ET.XMLParser(encoding="utf-8"))
+    for _event, element in context: strip_metadata_offsets(element) # Non-metadata tags fall through the dispatch
+    root = context.root; tree = ET.ElementTree(root)
+
+    log(f"Processing '{input_file}' for Finale (Transposing Key Sig, Rebuilding M1)...")
+
+    # --- 1. Perform General Fixes ---
+    apply_general_fixes(root, log)
+
+    # --- 2. Rebuild Measure 1 ---
+    log("  Rebuilding Measure 1...")
+    part1 = next(iter(_XP_PART1(root)), None)
+    if part1 is None: raise ValueError("Could not find <part id='P1'>")
+    measure1 = next(iter(_XP_M1(part1)), None)
+    if measure1 is None: raise ValueError("Could not find <measure number='1'> in Part P1")
+    result = rebuild_measure1(measure1, log)
+
+    # --- 7. Write Output ---
+    with replace_on_success(output_file) as f_out: tree.write(f_out, encoding='utf-8', xml_declaration=True, method='xml')
+    return result
+
+def fix_transpose_key_rebuild_measure1(input_file, output_file, log=print):
     """
     Parses MusicXML, applies general fixes, TRANSPOSES KEY SIGNATURE UP one step,
     reconstructs Measure 1 notes using READ original musical data and reference structure.
     Preserves text elsewhere. NOTE: Only key signature changes, not pitches.
+    Progress goes through log (print by default); errors always go to stderr.
     """
     try:
-        parser = ET.XMLParser(encoding="utf-8")
-        tree = ET.parse(input_file, parser=parser)
-        root = tree.getroot()
-
-        print(f"Processing '{input_file}' for Finale (Transposing Key Sig, Rebuilding M1)...")
-
-        # --- 1. Perform General Fixes ---
-        print("  Applying general fixes...")
-        # (General fixes code remains the same)
-        attributes_removed_count = 0
-        metadata_elements_to_clean = [('movement-title', '.'), ('creator', './/identification/creator'), ('rights', './/identification/rights')]
-        for tag_name, path in metadata_elements_to_clean:
-            for element in root.findall(path):
-                if element.tag == tag_name:
-                    if element.attrib.pop('relative-x', None): attributes_removed_count += 1
-                    if element.attrib.pop('relative-y', None): attributes_removed_count += 1
-        #if attributes_removed_count > 0: print(f"    Removed {attributes_removed_count} relative-x/y from metadata.") # Less verbose
-
-        identification_element = root.find('identification')
-        if identification_element is not None:
-            desc = identification_element.find('description');
-            if desc is not None and safe_remove_child(identification_element, desc): pass # print("    Removed misplaced <description>.")
-            encoding_element = identification_element.find('encoding')
-            if encoding_element is not None:
-                enc_date = encoding_element.find('encoding-date')
-                if enc_date is not None and (not enc_date.text or not enc_date.text.strip()):
-                    if safe_remove_child(encoding_element, enc_date): pass # print("    Removed empty <encoding-date>.")
-        # else: print("    Warning: <identification> section not found.")
-
-        subtitle = root.find('movement-subtitle');
-        if subtitle is not None and safe_remove_child(root, subtitle): pass # print("    Removed misplaced <movement-subtitle>.")
-
-        root.set('version', '4.0'); # print("    Set score-partwise version to 4.0.")
-
-        if root.find('defaults') is None:
-            defaults_element = create_defaults_element(); insert_idx = find_defaults_insert_index(root)
-            root.insert(insert_idx, defaults_element); print(f"    Injected <defaults> section.")
-        # else: print("    <defaults> section already exists.")
-        print("  General fixes applied.")
-
-
-        # --- 2. Rebuild Measure 1 ---
-        print("  Rebuilding Measure 1...")
-        part1 = root.find('.//part[@id="P1"]')
-        if part1 is None: raise ValueError("Could not find <part id='P1'>")
-        measure1 = part1.find('./measure[@number="1"]')
-        if measure1 is None: raise ValueError("Could not find <measure number='1'> in Part P1")
-
-        # --- Store original Measure 1 data ---
-        original_attributes_elem = measure1.find('attributes')
-        original_notes_elems = list(measure1.findall('note'))
-        original_left_barline = measure1.find('barline[@location="left"]')
-        original_right_barline = measure1.find('barline[@location="right"]')
-
-        if original_attributes_elem is None: raise ValueError("Measure 1 is missing <attributes>")
-
-        # --- Read original attributes AND CALCULATE TRANSPOSED KEY ---
-        original_key_elem = original_attributes_elem.find('.//key')
-        original_fifths_text = "-2" # Default for Bb Major if missing
-        original_key_mode = 'major' # Default mode
-        if original_key_elem is not None:
-            original_fifths_text = original_key_elem.findtext('fifths', original_fifths_text)
-            original_key_mode = original_key_elem.findtext('mode', original_key_mode)
-        else: print("    Warning: <key> element not found. Assuming original Bb Major (-2).")
-
-        transposed_key_fifths = original_fifths_text # Default to original if conversion fails
-        try:
-            original_fifths_val = int(original_fifths_text)
-            transposed_fifths_val = original_fifths_val + 1 # TRANSPOSE UP!
-            transposed_key_fifths = str(transposed_fifths_val)
-            print(f"    Transposing Key Signature: Original fifths={original_fifths_val} -> New fifths={transposed_fifths_val} ({original_key_mode})")
-        except ValueError:
-            print(f"    Warning: Could not parse original fifths value '{original_fifths_text}'. Key signature not transposed.")
-
-        # Read other necessary attributes
-        original_divisions = original_attributes_elem.findtext('.//divisions', '128')
-        original_time_beats = original_attributes_elem.findtext('.//time/beats', '4')
-        original_time_beat_type = original_attributes_elem.findtext('.//time/beat-type', '4')
-        original_clef_sign = original_attributes_elem.findtext('.//clef/sign', 'G')
-        original_clef_line = original_attributes_elem.findtext('.//clef/line', '2')
-        # --- End Reading Attributes ---
-
-
-        # --- Read original notes data ---
-        original_notes_data = []
-        # print("    Reading original notes from Measure 1...") # Less verbose
-        for old_note in original_notes_elems:
-             note_data = {'pitch_elem': None, 'rest_elem': None, 'duration_elem': None, 'type_elem': None}
-             pitch = old_note.find('pitch'); rest = old_note.find('rest')
-             if pitch is not None: note_data['pitch_elem'] = pitch
-             elif rest is not None: note_data['rest_elem'] = rest
-             if note_data['pitch_elem'] or note_data['rest_elem']:
-                  note_data['duration_elem'] = old_note.find('duration')
-                  note_data['type_elem'] = old_note.find('type')
-                  if note_data['duration_elem'] is not None and note_data['type_elem'] is not None:
-                       original_notes_data.append(note_data)
-        # print(f"    Read {len(original_notes_data)} valid note/rest elements.")
-
-
-        # --- Clear and Reconstruct Measure ---
-        # print("    Clearing original Measure 1 content...") # Less verbose
-        measure1.clear(); measure1.set('number', '1')
-        if original_left_barline is not None: measure1.append(original_left_barline)
-
-        # --- Add Reconstructed <attributes> using TRANSPOSED key ---
-        # print("    Adding reconstructed <attributes>...") # Less verbose
-        attributes_rebuilt = ET.Element('attributes')
-        ET.SubElement(attributes_rebuilt, 'divisions').text = original_divisions
-        key_rebuilt = ET.SubElement(attributes_rebuilt, 'key')
-        ET.SubElement(key_rebuilt, 'fifths').text = transposed_key_fifths # USE TRANSPOSED VALUE
-        ET.SubElement(key_rebuilt, 'mode').text = original_key_mode # Keep original mode
-        time_rebuilt = ET.SubElement(attributes_rebuilt, 'time'); ET.SubElement(time_rebuilt, 'beats').text = original_time_beats; ET.SubElement(time_rebuilt, 'beat-type').text = original_time_beat_type
-        clef_rebuilt = ET.SubElement(attributes_rebuilt, 'clef'); ET.SubElement(clef_rebuilt, 'sign').text = original_clef_sign; ET.SubElement(clef_rebuilt, 'line').text = original_clef_line
-        measure1.append(attributes_rebuilt)
-
-        # --- Add <print> element ---
-        # print("    Adding <print> element...") # Less verbose
-        print_elem = ET.Element('print'); sys_layout = ET.SubElement(print_elem, 'system-layout'); sys_margins = ET.SubElement(sys_layout, 'system-margins')
-        ET.SubElement(sys_margins, 'left-margin').text = '50'; ET.SubElement(sys_margins, 'right-margin').text = '0'
-        ET.SubElement(sys_layout, 'top-system-distance').text = '70'
-        measure1.append(print_elem)
-
-        # --- Add reconstructed <direction> for tempo ---
-        # print("    Adding reconstructed <direction> with tempo...") # Less verbose
-        direction_elem = ET.Element('direction', {'placement': 'above'}); dir_type = ET.SubElement(direction_elem, 'direction-type')
-        metronome = ET.SubElement(dir_type, 'metronome', {'parentheses': 'no'}); ET.SubElement(metronome, 'beat-unit').text = 'quarter'; ET.SubElement(metronome, 'per-minute').text = '120'
-        ET.SubElement(direction_elem, 'sound', {'tempo': '120'})
-        measure1.append(direction_elem)
-
-        # --- Re-add notes using READ data (same logic as before) ---
-        # print("    Re-adding notes using READ original data and reference structure...") # Less verbose
-        note_counter = 0; beam_level_1_state = None
-        beamable_indices = set()
-        if len(original_notes_data) > 3 and \
-           original_notes_data[1].get('type_elem') is not None and original_notes_data[1]['type_elem'].text == 'eighth' and \
-           original_notes_data[2].get('type_elem') is not None and original_notes_data[2]['type_elem'].text == 'eighth' and \
-           original_notes_data[3].get('type_elem') is not None and original_notes_data[3]['type_elem'].text == 'eighth':
-              beamable_indices = {1, 2, 3}
-
-        for i, note_data in enumerate(original_notes_data):
-            new_note = ET.Element('note')
-            if note_data['rest_elem'] is not None:
-                new_note.append(note_data['rest_elem']); beam_level_1_state = None
-            elif note_data['pitch_elem'] is not None:
-                new_note.append(note_data['pitch_elem'])
-                ET.SubElement(new_note, 'voice').text = '1'
-                step = note_data['pitch_elem'].findtext('step'); octave = int(note_data['pitch_elem'].findtext('octave', '4'))
-                stem_dir = 'down' if octave > 4 or (octave == 4 and step == 'B') else 'up' # Adjusted stem logic slightly
-                ET.SubElement(new_note, 'stem').text = stem_dir
-                if i in beamable_indices:
-                     if i == 1: ET.SubElement(new_note, 'beam', {'number': '1'}).text = 'begin'; beam_level_1_state = 'begin'
-                     elif i == 2: ET.SubElement(new_note, 'beam', {'number': '1'}).text = 'continue'; beam_level_1_state = 'continue'
-                     elif i == 3: ET.SubElement(new_note, 'beam', {'number': '1'}).text = 'end'; beam_level_1_state = None
-                else: beam_level_1_state = None
-            new_note.append(note_data['duration_elem']); new_note.append(note_data['type_elem'])
-            measure1.append(new_note)
-            note_counter += 1
-        # print(f"    Re-added {note_counter} notes to Measure 1 from read data.")
-
-        if original_right_barline is not None: measure1.append(original_right_barline)
-        print("  Measure 1 rebuild complete.")
-
-
-        # --- 7. Write Output ---
-        tree.write(output_file, encoding='utf-8', xml_declaration=True, method='xml')
-        print(f"\nSuccessfully wrote modified MusicXML to '{output_file}'")
-        print(f"NOTE: KEY SIGNATURE TRANSPOSED UP one step to fifths={transposed_key_fifths} ({original_key_mode}).")
-        print("      Pitches were NOT transposed. Applied general fixes & rebuilt Measure 1.")
-        print("      Text content preserved (except M1 lyrics omitted).")
-        print("      Try importing this file into Finale.")
+        fix_and_rebuild = stream_fix_and_rebuild if HAVE_LXML else tree_fix_and_rebuild
+        transposed_key_fifths, original_key_mode = fix_and_rebuild(input_file, output_file, log)
+        log(f"\nSuccessfully wrote modified MusicXML to '{output_file}'")
+        log(f"NOTE: KEY SIGNATURE TRANSPOSED UP one step to fifths={transposed_key_fifths} ({original_key_mode}).")
+        log("      Pitches were NOT transposed. Applied general fixes & rebuilt Measure 1.")
+        log("      Text content preserved (except M1 lyrics omitted).")
+        log("      Try importing this file into Finale.")
 
     except ET.ParseError as e:
         print(f"Error parsing MusicXML file '{input_file}': {e}", file=sys.stderr)
@@ -233,17 +345,60 @@ def fix_transpose_key_rebuild_measure1(input_file, output_file):
         traceback.print_exc()
         sys.exit(1)
 
+def quiet_log(*args, **kwargs):
+    """ Drop-in for print() that discards progress output (module-level so batch workers can receive it). """
+
+def run_batch(batch_in, batch_out, jobs=None, log=print):
+    """
+    Fixes every *.xml in batch_in into a same-named file in batch_out, fanned out over worker processes
+    so the interpreter and parser start-up is paid once per worker rather than once per file.
+    Returns the number of files that failed.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import glob
+    os.makedirs(batch_out, exist_ok=True)
+    pairs = [(input_file, os.path.join(batch_out, os.path.basename(input_file)))
+             for input_file in sorted(glob.glob(os.path.join(batch_in, '*.xml')))]
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = [pool.submit(fix_transpose_key_rebuild_measure1, input_file, output_file, log) for input_file, output_file in pairs]
+        for future in as_completed(futures):
+            try: future.result()
+            except SystemExit: failed += 1 # The worker has already reported the error on stderr
+    print(f"Batch complete: {len(pairs) - failed} of {len(pairs)} file(s) written to '{batch_out}'.")
+    return failed
+
 # --- Main Execution ---
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Fixes MusicXML for Finale, transposes KEY SIGNATURE up one step, rebuilds Measure 1.")
-    parser.add_argument("-f", "--from", dest="input_file", required=True,
+    parser.add_argument("-f", "--from", dest="input_file",
                         help="Input MusicXML file (e.g., input.xml)")
-    parser.add_argument("-t", "--to", dest="output_file", required=True,
+    parser.add_argument("-t", "--to", dest="output_file",
                         help="Output MusicXML file for Finale (e.g., ouput.xml)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Suppress progress messages (errors are still reported)")
+    parser.add_argument("--batch-in", dest="batch_in",
+                        help="Batch mode: fix every *.xml in this directory (instead of -f/-t)")
+    parser.add_argument("--batch-out", dest="batch_out",
+                        help="Batch mode: directory for the fixed files (same file names)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Batch mode: number of worker processes (default: CPU count)")
     args = parser.parse_args()
-
+    log = quiet_log if args.quiet else print
+
+    if args.batch_in or args.batch_out:
+        if not (args.batch_in and args.batch_out): parser.error("--batch-in and --batch-out must be given together")
+        if not os.path.isdir(args.batch_in):
+             print(f"Error: Input directory not found: {args.batch_in}", file=sys.stderr)
+             sys.exit(1)
+        if os.path.abspath(args.batch_in) == os.path.abspath(args.batch_out):
+             print("Error: --batch-out must differ from --batch-in (inputs would be overwritten while being read)", file=sys.stderr)
+             sys.exit(1)
+        sys.exit(1 if run_batch(args.batch_in, args.batch_out, args.jobs, log) else 0)
+
+    if not (args.input_file and args.output_file): parser.error("-f/--from and -t/--to are required (or use --batch-in/--batch-out)")
     if not os.path.exists(args.input_file):
          print(f"Error: Input file not found: {args.input_file}", file=sys.stderr)
          sys.exit(1)
 
-    fix_transpose_key_rebuild_measure1(args.input_file, args.output_file)
\ No newline at end of file
+    fix_transpose_key_rebuild_measure1(args.input_file, args.output_file, log)
@@ -5,9 +5,64 @@ import re
 import io
 import sys
 import math
+import functools
+
+# Lilypond duration keyed by beat count * 32 (quarter note = 32)
+DUR_MAP = {128:"1", 96:"2.", 64:"2", 48:"4.", 32:"4",
+           24:"8.", 16:"8", 12:"16.", 8:"16",
+           6:"32.", 4:"32"}
+
+# Absolute octave marks for a JPW octave offset (0 is the c' octave)
+OCTAVE_MARKS = {o: "'" * (o + 1) if o >= 0 else "," * -o for o in range(-8, 9)}
+
+# Articulation suffix indexed by (accent << 1) | prall
+ARTICULATIONS = ("", "-\\prall", "-\\accent", "-\\accent-\\prall")
+
+# Alternative ending marker ('|[1.'), plus the .Title fields read by parse_key_and_meters
+ALT_RE = re.compile(r"\|\|?\[(\d+)\.?.*")
+KEY_RE = re.compile(r"\{?\s*([16])\s*=\s*([A-Ga-g][#b]?)\s*,\s*([0-9]+/[0-9]+)\s*\}?", re.IGNORECASE)
+TITLE_RE = re.compile(r"\{?(.+)\}?")
+TEMPO_RE = re.compile(r"\{?\s*J\s*=\s*([0-9]+)\s*\}?")
+
+# Lilypond pitch for a KeyAndMeters key note ('e', 'be', 'eb', '#f', 'f#'); anything else is C
+KEY_NAMES = {n: n for n in 'abcdefg'}
+KEY_NAMES.update({k: n + suffix for n in 'abcdefg' for k, suffix in (('b' + n, 'es'), (n + 'b', 'es'), ('#' + n, 'is'), (n + '#', 'is'))})
+
+@functools.lru_cache(maxsize=None)
+def lily_duration(u_count, h_count, dot):
+    """Lilypond duration for a note with u_count '_', h_count '-' and an optional dot; None if none fits."""
+    # Beat counts are sums of powers of two, so beats*32 is exact and hashes like an int
+    dur = DUR_MAP.get((0.5 ** u_count + h_count) * (48 if dot else 32))
+    if dur is not None: return dur
+    beats = (0.5 ** u_count + h_count) * (1.5 if dot else 1.0)
+    for key, dur in DUR_MAP.items(): # Near misses (10+ underscores on top of a '-')
+        if abs(beats - key / 32) < 0.001: return dur
+    return None
+
+# Bar tokens whose Lilypond form does not depend on the repeat/alternative state
+STATIC_BARS = {"|": "|", "||": '\\bar "||"', "[|]": '\\bar "[|]"', ":|:": '\\bar ":|:"'}
+
+# Lilypond base note for JPW digits 0-7 (0 is a rest)
+BASE_NOTES = ('r', 'c', 'd', 'e', 'f', 'g', 'a', 'b')
+
+def note_duration(u_count, h_count, dot):
+    """lily_duration, falling back (with a warning) to a quarter note when no Lilypond duration fits."""
+    dur = lily_duration(u_count, h_count, dot)
+    if dur is not None: return dur
+    print(f"Warning: Unusual beat count {(0.5 ** u_count + h_count) * (1.5 if dot else 1.0)}. Defaulting to '4'.")
+    return "4"
+
+def note_name(base_note, octave):
+    """Absolute Lilypond note name with octave marks; rests ('r') take no marks."""
+    if base_note == 'r': return 'r'
+    octave_marks = OCTAVE_MARKS.get(octave)
+    if octave_marks is None: octave_marks = "'" * (octave + 1) if octave > 0 else "," * -octave
+    return base_note + octave_marks
 
 # --- Note Class ---
 class Note:
+    __slots__ = ('base_note', 'octave', 'lily_duration', 'is_rest', 'slur_start', 'slur_end', 'accent', 'prall', 'special')
+
     def __init__(self):
         self.base_note = None
         self.octave = 0
@@ -21,24 +76,27 @@ class Note:
 
     def get_lily_note_name(self):
         """Calculates the absolute Lilypond note name with octave marks."""
-        if self.is_rest: return 'r'
-        base = self.base_note
-        relative_octave = self.octave
-        if relative_octave == 0: octave_marks = "'"
-        elif relative_octave > 0: octave_marks = "'" * (relative_octave + 1)
-        else: octave_marks = "," * abs(relative_octave)
-        return base + octave_marks
+        return 'r' if self.is_rest else note_name(self.base_note, self.octave)
 
     def __unicode__(self):
         if self.special: return self.special
-        parts = [self.get_lily_note_name(), self.lily_duration]
-        if self.accent: parts.append("-\\accent")
-        if self.prall: parts.append("-\\prall")
-        return "".join(parts)
+        return f"{self.get_lily_note_name()}{self.lily_duration}{ARTICULATIONS[(self.accent << 1) | self.prall]}"
 
     def __str__(self):
         return self.__unicode__()
 
+def make_note(base_note, octave, u_count, h_count, dot, flags):
+    """Builds the Note for one parsed note; flags are slur_start << 2 | accent << 1 | prall."""
+    note = Note()
+    note.base_note, note.octave, note.lily_duration = base_note, octave, note_duration(u_count, h_count, dot)
+    note.is_rest = base_note == 'r'
+    note.slur_start, note.accent, note.prall = bool(flags & 4), bool(flags & 2), bool(flags & 1)
+    return note
+
+def note_text(base_note, octave, u_count, h_count, dot, flags):
+    """Renders one parsed note straight to text, e.g. "(c''8.-\\accent"; used by the stream=True parse."""
+    return f"{'(' if flags & 4 else ''}{note_name(base_note, octave)}{note_duration(u_count, h_count, dot)}{ARTICULATIONS[flags & 3]}"
+
 class IllegalFormatException(Exception):
     pass
 
@@ -61,63 +119,60 @@ class JpwFile:
     def __str__(self): return self.__unicode__()
 
     def parse(self, from_file):
-        try:
-            input_content = io.open(from_file, 'r', encoding='utf-16').read()
-            print(f"Read {from_file} with UTF-16.")
-        except UnicodeDecodeError:
-            try:
-                print("UTF-16 failed, trying GBK...")
-                input_content = io.open(from_file, 'r', encoding='gbk').read()
-                print(f"Read {from_file} with GBK.")
-            except Exception as e2: print(f"Error decoding {from_file}: {e2}"); return None
-        except Exception as e_other: print(f"Error reading {from_file}: {e_other}"); return None
-
         section_map = {
             'options': self.options, 'fonts': self.fonts, 'title': self.title,
             'voice': self.voice_lines, 'words': self.words,
             'attachments': self.attachments, 'page': self.page
         }
-        current_section_list = None
-        for line in input_content.splitlines():
-            line_strip = line.strip()
-            if not line_strip or line_strip.startswith('//'): continue
-            if line.startswith("."):
-                section_name = line[1:].strip().lower()
-                current_section_list = section_map.get(section_name)
-                continue
-            if current_section_list is not None: current_section_list.append(line)
+        try:
+            with io.open(from_file, 'rb') as f_in:
+                # Pick the decoder from the BOM (or the NULs of BOM-less UTF-16) instead of failing a full UTF-16 decode first
+                head = f_in.read(64)
+                if head[:2] in (b'\xff\xfe', b'\xfe\xff'): encodings = [('utf-16', 'UTF-16')]
+                elif b'\x00' in head: encodings = [('utf-16-be' if head[:1] == b'\x00' else 'utf-16-le', 'UTF-16')]
+                else: encodings = [('utf-8-sig', 'UTF-8'), ('gbk', 'GBK')] # UTF-8 first: GBK would also accept most UTF-8 bytes, as mojibake
+                for encoding, enc_name in encodings:
+                    f_in.seek(0)
+                    text_in = io.TextIOWrapper(f_in, encoding=encoding)
+                    try: self._read_sections(text_in, section_map); break
+                    except UnicodeDecodeError as e2: decode_error = e2
+                    finally: text_in.detach() # Leave f_in open for the next attempt
+                else: print(f"Error decoding {from_file}: {decode_error}"); return None
+        except Exception as e_other: print(f"Error reading {from_file}: {e_other}"); return None
+        print(f"Read {from_file} with {enc_name}.")
         return True
 
-    def number_to_base_note(self, n_char):
-        return {'1':'c', '2':'d', '3':'e', '4':'f', '5':'g', '6':'a', '7':'b', '0':'r'}.get(n_char)
-
-    def calculate_lily_duration_from_jpw(self, u_count, h_count, dot):
-        beats = 1.0 * (0.5 ** u_count) + float(h_count)
-        if dot: beats *= 1.5
-        tolerance = 0.001
-        dur_map = {4.0:"1", 3.0:"2.", 2.0:"2", 1.5:"4.", 1.0:"4",
-                   0.75:"8.", 0.5:"8", 0.375:"16.", 0.25:"16",
-                   0.1875:"32.", 0.125:"32"}
-        for b, dur in dur_map.items():
-            if abs(beats - b) < tolerance: return dur
-        print(f"Warning: Unusual beat count {beats}. Defaulting to '4'.")
-        return "4"
-
-    def _finalize_current_note(self, note, u_count, h_count, dot):
-        """Helper to finalize note duration and add to list."""
-        if note:
-            note.lily_duration = self.calculate_lily_duration_from_jpw(u_count, h_count, dot)
-            self.notes.append(note)
-        return None # Return None to clear current_note
-
-    def parse_voice_char_by_char(self):
-        self.notes = []
-        current_note = None
+    def _read_sections(self, text_in, section_map):
+        """Streams decoded lines into the section lists; clears them first so a retry starts clean."""
+        for section in section_map.values(): del section[:]
+        current_section_list = None
+        for text_line in text_in:
+            for line in text_line.splitlines(): # Also splits on the rarer separators, as str.splitlines always did
+                line_strip = line.strip()
+                if not line_strip or line_strip.startswith('//'): continue
+                if line.startswith("."):
+                    section_name = line[1:].strip().lower()
+                    current_section_list = section_map.get(section_name)
+                    continue
+                if current_section_list is not None: current_section_list.append(line)
+
+    def parse_voice_char_by_char(self, stream=False):
+        """Fills self.notes with Note objects and bar/command strings.
+
+        With stream=True each note is appended already rendered as Lilypond text (see note_text),
+        skipping the Note objects when the notes are only going to be written out.
+        """
+        self.notes = notes = []
+        # Bound once; these are used for every char. Finalizing a note is inlined below: build, append, clear
+        notes_append, parse_token, parse_bars = notes.append, self.parse_multichar_token, self.parse_bars
+        finish_note = note_text if stream else make_note
+        bar_at = slur_end_at = -1 # Index of the last bar/command item and of the last note given a slur end
+        note_base, note_flags = None, 0 # Active note: base name ('r' for a rest) and slur_start/accent/prall bits; octave is o_mod
         o_mod, u_count, h_count = 0, 0, 0
         dot = False
         in_special = False; special_content = ""
         in_dollar = False
-        self.is_inside_slur = False # Reset state
+        in_slur = self.is_inside_slur = False # Local mirror of self.is_inside_slur, written back per line
 
         for line_idx, line in enumerate(self.voice_lines):
             i, line_len = 0, len(line)
@@ -126,93 +181,104 @@ class JpwFile:
                 try:
                     # --- Formatting/Special Commands ---
                     if char == '$' and i + 1 < line_len and line[i+1] == '(':
-                        current_note = self._finalize_current_note(current_note, u_count, h_count, dot)
-                        o_mod, u_count, h_count, dot = 0, 0, 0, False; self.is_inside_slur = False # Reset state fully
-                        in_dollar = True; i += 1; continue
+                        if note_base: notes_append(finish_note(note_base, o_mod, u_count, h_count, dot, note_flags)); note_base = None
+                        o_mod, u_count, h_count, dot = 0, 0, 0, False; in_slur = False # Reset state fully
+                        end = line.find(')', i + 2)
+                        if end != -1: in_dollar = False; i = end + 1; continue # Skip the whole $(...) at once
+                        in_dollar = True; i += 1; continue # Runs on into the next line
                     if in_dollar:
                         if char == ')': in_dollar = False
                         i += 1; continue
                     if char == '{':
+                        end = line.find('}', i + 1)
+                        special_content = line[i+1:end]
+                        if end != -1 and '$(' not in special_content: # Whole {...} on this line
+                            special_content = special_content.rpartition('{')[2]
+                            if note_base: # Apply special content if note active
+                                if special_content == 'ZhongYin': note_flags |= 2
+                                elif special_content == 'BoYin': note_flags |= 1
+                            in_special = False; i = end + 1; continue
                         in_special = True; special_content = ""; i += 1; continue
                     if in_special:
                         if char == '}':
                             in_special = False
-                            if current_note: # Apply special content if note active
-                                if special_content == 'ZhongYin': current_note.accent = True
-                                elif special_content == 'BoYin': current_note.prall = True
+                            if note_base: # Apply special content if note active
+                                if special_content == 'ZhongYin': note_flags |= 2
+                                elif special_content == 'BoYin': note_flags |= 1
                         else: special_content += char
                         i += 1; continue
 
                     # --- Slurs/Groupings ---
                     if char == '(':
-                        current_note = self._finalize_current_note(current_note, u_count, h_count, dot)
+                        if note_base: notes_append(finish_note(note_base, o_mod, u_count, h_count, dot, note_flags)); note_base = None
                         o_mod, u_count, h_count, dot = 0, 0, 0, False
-                        self.is_inside_slur = True # Mark start
+                        in_slur = True # Mark start
                         i += 1; continue
                     if char == ')':
-                        if self.is_inside_slur: # Only process ')' if a slur was started
-                            current_note = self._finalize_current_note(current_note, u_count, h_count, dot)
-                            if self.notes and isinstance(self.notes[-1], Note):
-                                self.notes[-1].slur_end = True # Mark previous note as end
+                        if in_slur: # Only process ')' if a slur was started
+                            if note_base: notes_append(finish_note(note_base, o_mod, u_count, h_count, dot, note_flags)); note_base = None
+                            last = len(notes) - 1
+                            if last >= 0 and last != bar_at and last != slur_end_at: # Last item is a note not yet ending a slur
+                                if stream: notes[last] += ")"
+                                else: notes[last].slur_end = True # Mark previous note as end
+                                slur_end_at = last
                             # else: print(f"Warning: Slur end ')' without preceding note L{line_idx+1} C{i+1}") # Less noisy
                             o_mod, u_count, h_count, dot = 0, 0, 0, False
-                            self.is_inside_slur = False # Mark end
+                            in_slur = False # Mark end
                         # else: print(f"Warning: Unexpected ')' L{line_idx+1} C{i+1}") # Less noisy
                         i += 1; continue
 
                     # --- Barlines/Repeats (Check BEFORE digits/modifiers if inside slur) ---
                     is_bar_char = char in '|:['
-                    if is_bar_char and self.is_inside_slur:
+                    if is_bar_char and in_slur:
                         # print(f"Warning: Barline character '{char}' inside slur ignored L{line_idx+1} C{i+1}") # Less noisy
                         i += 1; continue # Skip bar processing inside slur
 
                     if is_bar_char:
-                        current_note = self._finalize_current_note(current_note, u_count, h_count, dot)
-                        o_mod, u_count, h_count, dot = 0, 0, 0, False; self.is_inside_slur = False # Bars reset state
-                        bar_token, consumed = self.parse_multichar_token(line, i, char); i += consumed
-                        bar_output = self.parse_bars(bar_token)
-                        if bar_output: self.notes.append(bar_output)
+                        if note_base: notes_append(finish_note(note_base, o_mod, u_count, h_count, dot, note_flags)); note_base = None
+                        o_mod, u_count, h_count, dot = 0, 0, 0, False; in_slur = False # Bars reset state
+                        bar_token, consumed = parse_token(line, i, char); i += consumed
+                        bar_output = parse_bars(bar_token)
+                        if bar_output: bar_at = len(notes); notes_append(bar_output)
                         i += 1; continue # Advance past the token
 
                     # --- Note Digits ---
                     if char.isdigit():
-                        current_note = self._finalize_current_note(current_note, u_count, h_count, dot) # Finalize previous
+                        if note_base: notes_append(finish_note(note_base, o_mod, u_count, h_count, dot, note_flags)); note_base = None # Finalize previous
                         o_mod, u_count, h_count, dot = 0, 0, 0, False # Reset for new note
-                        current_note = Note(); current_note.base_note = self.number_to_base_note(char)
-                        if current_note.base_note is None: print(f"Error: Unknown digit '{char}'"); current_note = None; i += 1; continue
-                        if current_note.base_note == 'r': current_note.is_rest = True
-                        if self.is_inside_slur: current_note.slur_start = True # Apply if inside slur
+                        base_idx = ord(char) - 48 # JPW digit 0-7
+                        if not 0 <= base_idx < 8: print(f"Error: Unknown digit '{char}'"); i += 1; continue
+                        note_base = BASE_NOTES[base_idx]; note_flags = 4 if in_slur else 0 # slur_start if inside slur
 
                     # --- Modifiers ---
-                    elif current_note: # Only apply if note active
-                        if char == "'": o_mod += 1; current_note.octave = o_mod
-                        elif char == ",": o_mod -= 1; current_note.octave = o_mod
+                    elif note_base: # Only apply if note active
+                        if char == "'": o_mod += 1
+                        elif char == ",": o_mod -= 1
                         elif char == '_': u_count += 1
                         elif char == '-': h_count += 1
                         elif char == '.':
                             if not dot: dot = True
                             else: print(f"Warning: Multiple '.' L{line_idx+1} C{i+1}")
                         elif not char.isspace(): # Implicit end of note?
-                            current_note = self._finalize_current_note(current_note, u_count, h_count, dot)
-                            o_mod, u_count, h_count, dot = 0, 0, 0, False; self.is_inside_slur = False
+                            if note_base: notes_append(finish_note(note_base, o_mod, u_count, h_count, dot, note_flags)); note_base = None
+                            o_mod, u_count, h_count, dot = 0, 0, 0, False; in_slur = False
                             i -= 1 # Re-process this char
 
                     # --- Spaces ---
-                    elif char.isspace():
-                        current_note = self._finalize_current_note(current_note, u_count, h_count, dot)
-                        o_mod, u_count, h_count, dot = 0, 0, 0, False; self.is_inside_slur = False # Spaces also reset state/slur
+                    elif char.isspace(): # Only reached with no active note, so nothing to finalize
+                        o_mod, u_count, h_count, dot = 0, 0, 0, False; in_slur = False # Spaces also reset state/slur
 
                     # --- Unhandled ---
-                    elif not self.is_inside_slur: # Don't warn if inside slur, might be text
+                    elif not in_slur: # Don't warn if inside slur, might be text
                          pass # print(f"Warning: Skipping unexpected char '{char}' L{line_idx+1} C{i+1}") # Less noisy
 
                     i += 1 # Advance loop
                 except Exception as e_inner: print(f"Error parsing L{line_idx+1} C{i+1}: {e_inner}"); i += 1 # Skip char on error
 
             # --- End of Line ---
-            current_note = self._finalize_current_note(current_note, u_count, h_count, dot)
+            if note_base: notes_append(finish_note(note_base, o_mod, u_count, h_count, dot, note_flags)); note_base = None
             o_mod, u_count, h_count, dot = 0, 0, 0, False
-            self.is_inside_slur = False # Reset slur state at end of line
+            in_slur = self.is_inside_slur = False # Reset slur state at end of line
 
     def parse_multichar_token(self, line, index, start_char):
         token = start_char; consumed = 0; line_len = len(line)
@@ -222,7 +288,7 @@ class JpwFile:
                 elif line[index+1] == '|': token = "||"; consumed = 1
                 elif line[index+1] == ':': token = "|:"; consumed = 1
                 elif line[index+1] == '[':
-                    alt_match = re.match(r"\|\|?\[(\d+)\.?.*", line[index:])
+                    alt_match = ALT_RE.match(line, index)
                     if alt_match:
                         end_alt = line.find(')', index)
                         token = line[index : end_alt+1] if end_alt != -1 else alt_match.group(0)
@@ -238,15 +304,13 @@ class JpwFile:
     def parse_bars(self, token):
         """Generates Lilypond commands/bars, including structure braces."""
         token = token.strip()
-        if token == "|": return "|"
-        if token == "||": return "\\bar \"||\""
-        if token == "[|]": return "\\bar \"[|]\""
+        bar = STATIC_BARS.get(token) # Plain bars (nearly all of them) need no repeat state
+        if bar is not None: return bar
         if token == "|:":
             self.alternative_closing_needed = 0 # Ensure clean state
             return "\\bar \"|:\""
-        if token == ":|:": return "\\bar \":|:\""
 
-        alt_match = re.match(r"\|\|?\[(\d+)\.?.*", token)
+        alt_match = ALT_RE.match(token)
         if alt_match:
             if not self.alternative_opened:
                  volta_num = 2; prefix = f"\\repeat volta {volta_num} {{";
@@ -265,16 +329,7 @@ class JpwFile:
         return '|'
 
     def parse_note_key(self, note_str):
-        note_str = note_str.strip().lower()
-        if not note_str: return "c"
-        if len(note_str) == 1: return note_str if 'a' <= note_str <= 'g' else "c"
-        elif len(note_str) == 2:
-            if note_str.startswith('b') and 'a' <= note_str[1] <= 'g': return note_str[1] + "es"
-            if note_str.startswith('#') and 'a' <= note_str[1] <= 'g': return note_str[1] + "is"
-            if note_str.endswith('b') and 'a' <= note_str[0] <= 'g': return note_str[0] + "es"
-            if note_str.endswith('#') and 'a' <= note_str[0] <= 'g': return note_str[0] + "is"
-        # print(f"Warning: Could not parse key note '{note_str}', using C.") # Less noisy
-        return "c"
+        return KEY_NAMES.get(note_str.strip().lower(), "c")
 
     def to_lilypond(self):
         """Generates the Lilypond output string using absolute octaves and includes MIDI output block."""
@@ -308,41 +363,33 @@ class JpwFile:
         lines.append('')
 
         # --- Format Notes and Music ---
-        output_line = "    "
+        output_parts, output_len = [], 4 # Pieces of the current music line; length counts its 4-space indent
         item_count_on_line = 0; line_limit = 60
 
         for item in self.notes:
-            item_str = ""
-            is_structural_command = False
-
             if isinstance(item, Note):
-                note_str = str(item)
-                if item.slur_start: item_str += "("
-                item_str += note_str
-                if item.slur_end: item_str += ")"
-                item_str += " "
-            elif isinstance(item, str): # Barline or command
-                 item_str_strip = item.strip()
-                 if item_str_strip.startswith("\\") or item_str_strip.startswith("}"):
-                     is_structural_command = True
-                     if output_line.strip(): lines.append(output_line.strip())
-                     indent = "  " if item_str_strip.startswith(("\\repeat", "\\alternative")) else "    "
+                item_str = f"{'(' if item.slur_start else ''}{item}{')' if item.slur_end else ''} "
+            elif item[0] in "\\}": # Structural command from parse_bars (\bar, \repeat, closing braces)
+                     item_str_strip = item.strip()
+                     line_str = "".join(output_parts).strip()
+                     if line_str: lines.append(line_str)
+                     indent = "  " if item_str_strip[:2] in ("\\r", "\\a") else "    " # \repeat / \alternative (parse_bars emits no other \r, \a)
                      if item_str_strip.endswith("}") and item_str_strip != "} {": indent = "    " # Closing braces more indented
                      lines.append(indent + item_str_strip)
-                     output_line = "    "; item_count_on_line = 0
+                     output_parts, output_len = [], 4; item_count_on_line = 0
                      continue
-                 else: item_str = item_str_strip + " " # Simple bar "|"
+            else: item_str = item + " " # Simple bar "|", or a note already rendered by a stream=True parse
 
-            output_line += item_str
+            output_parts.append(item_str); output_len += len(item_str)
             item_count_on_line += 1
 
-            is_bar = isinstance(item, str) and "|" in item
-            if is_bar and len(output_line) > line_limit:
-                lines.append(output_line.strip())
-                output_line = "    "
+            if item == "|" and output_len > line_limit:
+                lines.append("".join(output_parts).strip())
+                output_parts, output_len = [], 4
                 item_count_on_line = 0
 
-        if output_line.strip(): lines.append(output_line.strip())
+        line_str = "".join(output_parts).strip()
+        if line_str: lines.append(line_str)
 
         # Add closing braces for \alternative and \repeat if needed
         if self.alternative_closing_needed > 0:
@@ -365,10 +412,6 @@ class JpwFile:
 
 
     def parse_key_and_meters(self):
-        key_pattern = re.compile(r"\{?\s*([16])\s*=\s*([A-Ga-g][#b]?)\s*,\s*([0-9]+/[0-9]+)\s*\}?", re.IGNORECASE)
-        title_pattern = re.compile(r"\{?(.+)\}?")
-        tempo_pattern = re.compile(r"\{?\s*J\s*=\s*([0-9]+)\s*\}?")
-
         p_title, p_key, p_tempo = False, False, False
         for t_line in self.title:
             parts = t_line.split("=", 1)
@@ -376,15 +419,15 @@ class JpwFile:
             key, value = parts[0].strip().lower(), parts[1].strip()
 
             if key == "keyandmeters" and not p_key:
-                match = key_pattern.search(value)
+                match = KEY_RE.search(value)
                 if match: self.key = f"{match.group(1)}={match.group(2).upper()}"; self.sig = match.group(3); p_key = True
                 # else: print(f"Warn: Bad KeyAndMeters: {value}") # Less noisy
             elif key == "title" and not p_title:
-                 match = title_pattern.match(value)
+                 match = TITLE_RE.match(value)
                  self.song_title = match.group(1).strip().strip('{}') if match else value.strip('{}')
                  p_title = True
             elif key == "expression" and not p_tempo:
-                 match = tempo_pattern.search(value)
+                 match = TEMPO_RE.search(value)
                  if match: self.tempo = match.group(1); p_tempo = True
 
 # --- Conversion Function and Main ---
@@ -392,7 +435,7 @@ def convert(from_file, to_file):
     jpw = JpwFile()
     if not jpw.parse(from_file): print("Error: Parse failed."); return
     jpw.parse_key_and_meters()
-    jpw.parse_voice_char_by_char()
+    jpw.parse_voice_char_by_char(stream=True) # The notes are only written out here, so render them while parsing
     try:
         ly_output = jpw.to_lilypond()
         with io.open(to_file, "w", encoding='utf-8') as f_out: f_out.write(ly_output)
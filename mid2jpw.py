@@ -2,9 +2,13 @@
 # -*- coding: utf-8 -*-
 from optparse import OptionParser
 import re
+import struct
 import io
 import sys
+import os
 import math
+import functools
+from operator import itemgetter
 # 需要安裝 mido: pip install mido
 try:
     import mido
@@ -12,46 +16,146 @@ except ImportError:
     print("錯誤：需要安裝 'mido' 函式庫才能解析 MIDI 檔案。")
     print("請執行： pip install mido")
     sys.exit(1)
+try:
+    # 逐條讀取音軌用；少見的訊息 (meta、sysex、系統訊息) 直接交給 mido 的解碼函式
+    # 這些是 mido 的內部函式 (以 mido 1.3 測試)，其他版本找不到時改用 mido.MidiFile 解析 (見 track_events_from_mido)
+    from mido.midifiles.midifiles import read_file_header, read_meta_message, read_sysex, read_message
+except ImportError:
+    read_file_header = None
 
 # --- Helper Functions (部分來自之前的腳本) ---
 
+def read_track_events(data, pos):
+    """從 data[pos] 讀取一條 MTrk 音軌，返回 (音軌名稱, 事件串列, 下一條音軌的位置)
+    事件為 (絕對 tick, 類型, 音高, 力度)，只保留 note_on / note_off；meta 訊息為 (tick, 'meta', MetaMessage, 0)。
+    通道訊息直接從位元組解碼 (VLQ delta、running status)，不建立 mido.Message 物件；
+    其餘訊息仍交給 mido，錯誤檢查與 mido 的 read_track 相同。"""
+    end_of_data = len(data)
+    if end_of_data - pos < 8: raise EOFError
+    chunk_name, size = struct.unpack_from('>4sL', data, pos)
+    if chunk_name != b'MTrk': raise OSError('no MTrk header at start of track')
+    pos += 8
+    end = pos + size
+    events = []
+    events_append = events.append
+    track_name = None
+    infile = None # 需要交給 mido 時才建立
+    tick = 0
+    last_status = None
+    while pos != end: # 與 mido 相同：剛好讀到音軌長度才結束
+        if pos >= end_of_data: raise EOFError
+        byte = data[pos]; pos += 1
+        delta = byte & 0x7f
+        while byte & 0x80: # delta time (VLQ)
+            if pos >= end_of_data: raise EOFError
+            byte = data[pos]; pos += 1
+            delta = (delta << 7) | (byte & 0x7f)
+        tick += delta
+        if pos >= end_of_data: raise EOFError
+        status = data[pos]; pos += 1
+        peek_data = []
+        if status < 0x80: # running status：這個位元組是第一個資料位元組
+            if last_status is None: raise OSError('running status without last_status')
+            peek_data = [status]
+            status = last_status
+        elif status != 0xff: # meta 訊息不設定 running status
+            last_status = status
+
+        if 0x80 <= status < 0xf0: # 通道訊息
+            size = 1 if 0xc0 <= status < 0xe0 else 2 # program_change / aftertouch 只有 1 個資料位元組
+            if peek_data: pos -= 1
+            if pos + size > end_of_data: raise EOFError
+            note = data[pos]
+            velocity = data[pos + 1] if size == 2 else 0
+            if note > 127 or velocity > 127: raise OSError('data byte must be in range 0..127')
+            pos += size
+            if status < 0xa0: events_append((tick, 'note_off' if status < 0x90 else 'note_on', note, velocity))
+            continue
+
+        if infile is None: infile = io.BytesIO(data)
+        infile.seek(pos)
+        if status == 0xff:
+            msg = read_meta_message(infile, delta)
+            tick += msg.time - delta # 與 mido 一致以 msg.time 累計 (未知類型的 meta 訊息 time 為 0)
+            if track_name is None and msg.type == 'track_name': track_name = msg.name
+            events_append((tick, 'meta', msg, 0))
+        elif status == 0xf0 or status == 0xf7:
+            read_sysex(infile, delta)
+        else:
+            read_message(infile, status, peek_data, delta)
+        pos = infile.tell()
+
+    return track_name or '', events, pos
+
+def track_events_from_mido(track):
+    """read_track_events 的後備 (mido 內部函式無法匯入時)：由 mido.MidiFile 已解析的音軌產生相同的 (音軌名稱, 事件串列)"""
+    events = []
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        if msg.type == 'note_on' or msg.type == 'note_off': events.append((tick, msg.type, msg.note, msg.velocity))
+        elif msg.is_meta: events.append((tick, 'meta', msg, 0))
+    return track.name, events
+
 def get_beats_from_ticks(ticks, ticks_per_beat):
     """將 MIDI ticks 轉換為拍數 (假設 quarter note = 1 beat)"""
     if ticks_per_beat is None or ticks_per_beat == 0:
         return 0.0 # 無法計算
     return float(ticks) / ticks_per_beat
 
-def calculate_jpw_modifiers_from_beats(beats):
-    """根據拍數反推 JPW 時值修飾符 (_, -, .)"""
+# 映射表：拍數 x 16 (皆為 1/16 拍的整數倍) -> (底線數量, 連字號數量, 是否有附點)
+DUR_MAP = {
+    64: (0, 3, False), 48: (0, 2, False), 32: (0, 1, False),
+    24: (0, 0, True),  16: (0, 0, False), 12: (1, 0, True),
+    8: (1, 0, False),  6: (2, 0, True),   4: (2, 0, False),
+    3: (3, 0, True),   2: (3, 0, False)
+}
+
+@functools.lru_cache(maxsize=None)
+def _jpw_modifiers_cached(beats):
+    """依拍數查表得 (底線數量, 連字號數量, 是否有附點)，無法映射時返回 None
+    (MIDI 音長多為少數幾種 tick 數，同一拍數值會反覆出現)"""
     tolerance = 0.01 # 稍微放寬容差以處理 MIDI 計時誤差
-    # 映射表：拍數 -> (底線數量, 連字號數量, 是否有附點)
-    dur_map = {
-        4.0: (0, 3, False), 3.0: (0, 2, False), 2.0: (0, 1, False),
-        1.5: (0, 0, True),  1.0: (0, 0, False), 0.75: (1, 0, True),
-        0.5: (1, 0, False), 0.375:(2, 0, True), 0.25: (2, 0, False),
-        0.1875:(3, 0, True),0.125:(3, 0, False)
-    }
-    for b, mods in dur_map.items():
-        if abs(beats - b) < tolerance:
-            return mods
+    # 量化到最近的 1/16 拍後直接查表，容差內才算命中
+    key = int(round(beats * 16))
+    mods = DUR_MAP.get(key)
+    if mods is not None and abs(beats - key / 16.0) < tolerance:
+        return mods
 
     # 嘗試近似處理更長或不規則的時值
     if beats > 4.0 and abs(beats % 1.0) < tolerance: # 嘗試處理 >4 拍的整數拍
         hyphens = int(round(beats)) - 1
         if hyphens >= 3: return (0, hyphens, False) # e.g., 5 beats -> 0, 4, False
+    return None
 
-    print(f"警告：無法精確映射拍數={beats} 到 JPW 時值修飾符。使用預設值 (基礎音符)。")
-    return (0, 0, False) # 預設返回基礎時值 (通常是四分音符)
+def calculate_jpw_modifiers_from_beats(beats):
+    """根據拍數反推 JPW 時值修飾符 (_, -, .)"""
+    mods = _jpw_modifiers_cached(beats)
+    if mods is None:
+        print(f"警告：無法精確映射拍數={beats} 到 JPW 時值修飾符。使用預設值 (基礎音符)。")
+        return (0, 0, False) # 預設返回基礎時值 (通常是四分音符)
+    return mods
+
+def get_beats_from_modifiers(u_count, h_count, dot):
+    """由 JPW 時值修飾符 (_, -, .) 計算記譜上的拍數，用於小節線估算"""
+    beats = 1.0 * (0.5 ** u_count) + float(h_count)
+    if dot: beats *= 1.5
+    return beats
+
+@functools.lru_cache(maxsize=None)
+def jpw_duration(u_count, h_count, dot):
+    """JPW 時值修飾符 -> (修飾符字串 e.g. "_.", 記譜拍數)；實際出現的組合只有少數幾種"""
+    return "_" * u_count + "-" * h_count + ("." if dot else ""), get_beats_from_modifiers(u_count, h_count, dot)
+
+# MIDI 調號字串 (e.g., 'C', 'Gm', 'F#m', 'Bb') -> 主音字母, 升降號
+KEY_RE = re.compile(r"([A-G])([#b])?m?")
 
 # 音階和 MIDI 編號的映射 (C大調/a小調)
 # C4 = 60, C#4 = 61, D4 = 62 ... B4 = 71, C5 = 72
 SCALE_CMAJ = {0: '1', 2: '2', 4: '3', 5: '4', 7: '5', 9: '6', 11: '7'} # 相對於 C 的音程 -> JPW 數字
 
-def midi_note_to_jpw_simple(midi_note_num):
+def _midi_note_to_jpw(midi_note_num):
     """簡化版：將 MIDI 音高數字轉換為 JPW 數字和八度標記 (基於 C 大調)"""
-    if not (0 <= midi_note_num <= 127):
-        return ('1', 0, '') # 無效音高返回預設
-
     octave = midi_note_num // 12
     note_in_octave = midi_note_num % 12
 
@@ -78,10 +182,19 @@ def midi_note_to_jpw_simple(midi_note_num):
 
     return (jpw_num, jpw_octave_mod, jpw_prefix)
 
+# 預先算好全部 128 個 MIDI 音高在 token 中的音高部分：升降號 + 數字 + 八度標記 (e.g., "#4'", "5,,")
+# 音高轉換只有這一張表 (由 _midi_note_to_jpw 產生)，產生音符 token 時直接以音高索引
+MIDI_JPW_TEXT = tuple(prefix + num + ("'" * oct_mod if oct_mod > 0 else "," * -oct_mod)
+                      for num, oct_mod, prefix in map(_midi_note_to_jpw, range(128)))
+
 
 # --- MidiToJpw Class ---
 
 class MidiToJpw:
+    # 屬性固定，以 __slots__ 省去每個實例的 __dict__
+    __slots__ = ('title', 'key_signature', 'key_mode', 'jpw_key_str', 'time_sig_num', 'time_sig_den', 'jpw_time_sig',
+                 'tempo_microseconds', 'jpw_tempo_str', 'ticks_per_beat', 'jpw_voice_tokens', 'verbose')
+
     def __init__(self):
         self.title = ""
         self.key_signature = 'C' # MIDI 調號 (預設 C)
@@ -93,20 +206,61 @@ class MidiToJpw:
         self.tempo_microseconds = 500000 # microseconds per quarter note (預設 120 BPM)
         self.jpw_tempo_str = "J=120"
         self.ticks_per_beat = 480 # MIDI Ticks per Beat (常用預設值)
-        self.jpw_voice_tokens = [] # 儲存轉換後的 JPW 音符/符號
+        self.jpw_voice_tokens = [] # 儲存轉換後的 JPW 音符/符號及其拍數: (token, beats)
+        self.verbose = False # True 時逐一印出音軌、元數據及每個音符/休止符
+
+    def handle_meta_message(self, msg):
+        """處理元數據訊息 (標題、速度、拍號、調號)"""
+        if msg.type == 'track_name' and not self.title:
+            self.title = msg.name
+            if self.verbose: print(f"  找到標題: {self.title}")
+        elif msg.type == 'set_tempo':
+            self.tempo_microseconds = msg.tempo
+            bpm = mido.tempo2bpm(msg.tempo)
+            self.jpw_tempo_str = f"J={int(round(bpm))}"
+            if self.verbose: print(f"  找到速度: {self.jpw_tempo_str} ({msg.tempo} us/beat)")
+        elif msg.type == 'time_signature':
+            self.time_sig_num = msg.numerator
+            self.time_sig_den = msg.denominator
+            # 檔案中存的是 2 的次方 (2=quarter, 3=eighth)，mido 解碼時已換算成實際分母 (4, 8)，不需再取 2**
+            self.jpw_time_sig = f"{self.time_sig_num}/{self.time_sig_den}"
+            if self.verbose: print(f"  找到拍號: {self.jpw_time_sig}")
+            # Lilypond ticks_per_beat *might* relate to denominator, but usually fixed per file.
+        elif msg.type == 'key_signature':
+            self.key_signature = msg.key # e.g., 'C', 'Gm', 'F#m'
+            # 嘗試轉換為 JPW 格式
+            match = KEY_RE.match(self.key_signature)
+            if match:
+                 base = match.group(1)
+                 acc = match.group(2) if match.group(2) else ''
+                 mode_num = '6' if 'm' in self.key_signature else '1'
+                 jpw_key = acc.replace('b','b').replace('#','#') + base # e.g., bE, #F
+                 self.jpw_key_str = f"{mode_num}={jpw_key}"
+            if self.verbose: print(f"  找到調號: {self.key_signature} -> JPW: {self.jpw_key_str}")
 
     def parse(self, midi_file_path):
         """解析 MIDI 檔案並提取資訊"""
+        # 不用 mido.MidiFile (會一次解析全部音軌並為每個訊息建立物件)：只讀檔頭，
+        # 音軌在迴圈中才以 read_track_events 逐條解碼，選定第一條含音符的音軌後其餘音軌完全不解析
+        midi_file = None # 只在 mido 內部函式無法匯入時使用
         try:
-            mid = mido.MidiFile(midi_file_path)
-            print(f"成功讀取 MIDI 檔案: '{midi_file_path}'")
+            with open(midi_file_path, 'rb') as f_in:
+                midi_bytes = f_in.read()
+            if read_file_header is None:
+                midi_file = mido.MidiFile(file=io.BytesIO(midi_bytes))
+                num_tracks, ticks_per_beat = len(midi_file.tracks), midi_file.ticks_per_beat
+            else:
+                midi_in = io.BytesIO(midi_bytes)
+                midi_type, num_tracks, ticks_per_beat = read_file_header(midi_in)
+                track_pos = midi_in.tell()
         except Exception as e:
             print(f"錯誤：無法讀取或解析 MIDI 檔案 '{midi_file_path}': {e}")
             return False
 
-        if mid.ticks_per_beat:
-            self.ticks_per_beat = mid.ticks_per_beat
-            print(f"  Ticks per beat: {self.ticks_per_beat}")
+        verbose = self.verbose
+        if ticks_per_beat:
+            self.ticks_per_beat = ticks_per_beat
+            if verbose: print(f"  Ticks per beat: {self.ticks_per_beat}")
         else:
              print(f"警告：MIDI 檔案未指定 ticks_per_beat，使用預設值 {self.ticks_per_beat}")
 
@@ -116,192 +270,165 @@ class MidiToJpw:
         track_found = False
 
         # 通常音軌 0 是元數據，音軌 1 或之後包含音符
-        for i, track in enumerate(mid.tracks):
-            print(f"處理音軌 {i}: {track.name}")
-            playing_notes = {} # {note_num: start_tick}
-            current_time_ticks = 0 # 每條音軌時間獨立
+        for i in range(num_tracks):
+            try:
+                if midi_file is None: track_name, track_events, track_pos = read_track_events(midi_bytes, track_pos)
+                else: track_name, track_events = track_events_from_mido(midi_file.tracks[i])
+            except Exception as e:
+                print(f"錯誤：無法讀取或解析 MIDI 檔案 '{midi_file_path}': {e}")
+                return False
+            if verbose: print(f"處理音軌 {i}: {track_name}")
+            playing_notes = [-1] * 128 # 依 MIDI 音高索引的開始 tick，-1 表示未在發聲
 
             # 第一次遍歷，獲取元數據和音符事件時間
             temp_notes = []
+            temp_notes_append = temp_notes.append # 迴圈內常用的方法先綁定為區域變數
             has_notes_in_this_track = False
-            for msg in track:
-                current_time_ticks += msg.time # 累加 delta time
-
-                if msg.is_meta:
-                    if msg.type == 'track_name' and not self.title:
-                        self.title = msg.name
-                        print(f"  找到標題: {self.title}")
-                    elif msg.type == 'set_tempo':
-                        self.tempo_microseconds = msg.tempo
-                        bpm = mido.tempo2bpm(msg.tempo)
-                        self.jpw_tempo_str = f"J={int(round(bpm))}"
-                        print(f"  找到速度: {self.jpw_tempo_str} ({msg.tempo} us/beat)")
-                    elif msg.type == 'time_signature':
-                        self.time_sig_num = msg.numerator
-                        self.time_sig_den = msg.denominator
-                        # MIDI denominator 是 2 的次方 (2=quarter, 3=eighth)
-                        actual_den = 2**msg.denominator
-                        self.jpw_time_sig = f"{self.time_sig_num}/{actual_den}"
-                        print(f"  找到拍號: {self.jpw_time_sig}")
-                        # Lilypond ticks_per_beat *might* relate to denominator, but usually fixed per file.
-                    elif msg.type == 'key_signature':
-                        self.key_signature = msg.key # e.g., 'C', 'Gm', 'F#m'
-                        # 嘗試轉換為 JPW 格式
-                        match = re.match(r"([A-G])([#b])?m?", self.key_signature)
-                        if match:
-                             base = match.group(1)
-                             acc = match.group(2) if match.group(2) else ''
-                             mode_num = '6' if 'm' in self.key_signature else '1'
-                             jpw_key = acc.replace('b','b').replace('#','#') + base # e.g., bE, #F
-                             self.jpw_key_str = f"{mode_num}={jpw_key}"
-                        print(f"  找到調號: {self.key_signature} -> JPW: {self.jpw_key_str}")
-
-                elif msg.type == 'note_on' and msg.velocity > 0:
+            for current_time_ticks, msg_type, note, velocity in track_events: # tick 為音軌內的絕對時間
+                # 音符訊息佔絕大多數，先判斷；元數據 (多在音軌 0) 交給 handle_meta_message
+                if msg_type == 'note_on' and velocity > 0:
                     has_notes_in_this_track = True
-                    playing_notes[msg.note] = current_time_ticks
-                elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-                    if msg.note in playing_notes:
-                        start_tick = playing_notes.pop(msg.note)
-                        end_tick = current_time_ticks
+                    playing_notes[note] = current_time_ticks
+                elif msg_type == 'note_off' or msg_type == 'note_on': # velocity 0 的 note_on 等同 note_off
+                    start_tick = playing_notes[note]
+                    if start_tick >= 0:
+                        playing_notes[note] = -1
                         # 儲存音符資訊 (音高, 開始, 結束)
-                        temp_notes.append({'pitch': msg.note, 'start': start_tick, 'end': end_tick})
+                        temp_notes_append((note, start_tick, current_time_ticks))
+                else: # 'meta'：第三欄是 mido 的 MetaMessage
+                    self.handle_meta_message(note)
 
             # 如果當前音軌包含音符且我們還沒選擇音軌，則使用此音軌
             if has_notes_in_this_track and not track_found:
                  print(f"  --> 選定音軌 {i} 進行轉換。")
+                 # 沒有對應 note_off 的音符 (檔案被截斷或不完整) 延續到音軌最後一個事件
+                 hanging_count = 0
+                 for note, start_tick in enumerate(playing_notes):
+                     if start_tick >= 0:
+                         temp_notes_append((note, start_tick, current_time_ticks))
+                         hanging_count += 1
+                 if hanging_count: print(f"警告：{hanging_count} 個音符沒有 note_off，延續到音軌結尾 (tick={current_time_ticks})。")
                  # 按開始時間排序音符
-                 notes_in_track = sorted(temp_notes, key=lambda x: x['start'])
+                 notes_in_track = sorted(temp_notes, key=itemgetter(1)) # 依開始 tick，穩定排序
                  track_found = True
                  # 只處理第一個找到音符的音軌，然後跳出
                  break
-            elif not track_found and i == len(mid.tracks) - 1: # 如果到最後一軌還沒找到音符
+            elif not track_found and i == num_tracks - 1: # 如果到最後一軌還沒找到音符
                  print("警告：在所有音軌中均未找到有效的音符事件。無法產生 JPW 聲音。")
-
+        # 音軌是在上面的迴圈中才解碼的，全部讀完沒有錯誤才算成功讀取
+        print(f"成功讀取 MIDI 檔案: '{midi_file_path}'")
 
         # --- 第二步：根據排序後的音符和時間生成 JPW tokens ---
         last_note_end_tick = 0
-        for note in notes_in_track:
-            start_tick = note['start']
-            end_tick = note['end']
-            pitch = note['pitch']
+        rest_count = skipped_count = 0
+        ticks_per_beat = self.ticks_per_beat
+        min_rest_ticks = ticks_per_beat * 0.05 # 只有顯著的間隔才算休止符 (忽略小誤差)
+        tokens_append = self.jpw_voice_tokens.append
+        for pitch, start_tick, end_tick in notes_in_track:
             duration_ticks = end_tick - start_tick
 
             # 1. 檢查是否有休止符
             rest_ticks = start_tick - last_note_end_tick
-            if rest_ticks > self.ticks_per_beat * 0.05: # 只有顯著的間隔才算休止符 (忽略小誤差)
-                rest_beats = get_beats_from_ticks(rest_ticks, self.ticks_per_beat)
-                u_count, h_count, dot = calculate_jpw_modifiers_from_beats(rest_beats)
-                rest_token = "0" # JPW 休止符
-                rest_token += "_" * u_count + "-" * h_count
-                if dot: rest_token += "."
-                self.jpw_voice_tokens.append(rest_token)
-                print(f"  - 插入休止符: tick={last_note_end_tick}-{start_tick}, beats={rest_beats:.2f}, token={rest_token}")
+            if rest_ticks > min_rest_ticks:
+                rest_beats = get_beats_from_ticks(rest_ticks, ticks_per_beat)
+                suffix, token_beats = jpw_duration(*calculate_jpw_modifiers_from_beats(rest_beats))
+                rest_token = "0" + suffix # JPW 休止符
+                # 同時保存記譜拍數，輸出時不必再由 token 字串反推
+                tokens_append((rest_token, token_beats))
+                rest_count += 1
+                if verbose: print(f"  - 插入休止符: tick={last_note_end_tick}-{start_tick}, beats={rest_beats:.2f}, token={rest_token}")
 
 
             # 2. 處理當前音符
             if duration_ticks <= 0: # 忽略零時值音符
-                print(f"  - 忽略零時值音符: pitch={pitch}, start={start_tick}")
+                skipped_count += 1
+                if verbose: print(f"  - 忽略零時值音符: pitch={pitch}, start={start_tick}")
                 continue
 
-            note_beats = get_beats_from_ticks(duration_ticks, self.ticks_per_beat)
-            u_count, h_count, dot = calculate_jpw_modifiers_from_beats(note_beats)
-            # 使用簡化版音高轉換
-            num, oct_mod, prefix = midi_note_to_jpw_simple(pitch)
-
-            if num:
-                jpw_token = prefix + num
-                if oct_mod > 0: jpw_token += "'" * oct_mod
-                elif oct_mod < 0: jpw_token += "," * abs(oct_mod)
-                jpw_token += "_" * u_count + "-" * h_count
-                if dot: jpw_token += "."
-                self.jpw_voice_tokens.append(jpw_token)
-                print(f"  - 添加音符: pitch={pitch}, tick={start_tick}-{end_tick}, beats={note_beats:.2f}, token={jpw_token}")
+            note_beats = get_beats_from_ticks(duration_ticks, ticks_per_beat)
+            suffix, token_beats = jpw_duration(*calculate_jpw_modifiers_from_beats(note_beats))
+            # 使用簡化版音高轉換 (查表；音高由 read_track_events 保證在 0-127)
+            jpw_token = MIDI_JPW_TEXT[pitch] + suffix
+            tokens_append((jpw_token, token_beats))
+            if verbose: print(f"  - 添加音符: pitch={pitch}, tick={start_tick}-{end_tick}, beats={note_beats:.2f}, token={jpw_token}")
 
 
             last_note_end_tick = end_tick
 
         if not track_found:
              print("警告：未找到包含音符的音軌，無法產生 .Voice 區段。")
+        else: # 以一行摘要取代逐音符輸出 (逐音符細節見 --verbose)
+             print(f"  {self.jpw_key_str}, {self.jpw_time_sig}, {self.jpw_tempo_str}: 產生 {len(self.jpw_voice_tokens) - rest_count} 個音符、{rest_count} 個休止符"
+                   + (f"，忽略 {skipped_count} 個零時值音符" if skipped_count else ""))
 
         return True
 
 
-    def build_jpw_output(self):
-        """格式化解析到的資訊為 JPW 字串"""
-        output = ["// ************** Generated JPW File from MIDI **************", ""]
-        # 省略 .Options, .Fonts
-        output.append(".Title")
-        if self.title: output.append(f"Title = {{{self.title}}}")
-        output.append(f"KeyAndMeters = {{{self.jpw_key_str},{self.jpw_time_sig}}}")
-        if self.jpw_tempo_str: output.append(f"Expression = {{{self.jpw_tempo_str}}}")
-        output.extend(["", ".Voice"])
-
+    def iter_voice_lines(self):
+        """逐行產生 .Voice 區段的內容 (token 以空白分隔，"|" 為小節線)"""
         # 基本的聲音 token 格式化，每 8 個 token 嘗試換行
-        line = "  "
+        line_parts = [] # 當前行的 token 及小節線，換行時以空白 join
         token_count = 0
         max_tokens_per_line = 8
         bar_counter = 0 # 簡易小節計數
         beats_in_bar = 0.0
         beats_per_bar = float(self.time_sig_num) # 假設 time_sig_den 是 4
 
-        for token in self.jpw_voice_tokens:
-             # 嘗試估算 token 的拍數以插入小節線 (非常粗略)
-             current_beats = 1.0 # 預設
-             if token.startswith('0'): # 休止符
-                 u_count = token.count('_')
-                 h_count = token.count('-')
-                 dot = '.' in token
-                 mods = calculate_jpw_modifiers_from_beats(1.0) # 獲取基礎拍數
-                 # 反向估算 (不準確)
-                 temp_beats = 1.0 * (0.5 ** u_count) + float(h_count)
-                 if dot: temp_beats *= 1.5
-                 current_beats = temp_beats
-             else: # 音符
-                 match = re.match(r"[#b]?([1-7])(['`,]*)([_.-]*)", token)
-                 if match:
-                     dur_mods = match.group(3)
-                     u_count = dur_mods.count('_')
-                     h_count = dur_mods.count('-')
-                     dot = '.' in dur_mods
-                     mods = calculate_jpw_modifiers_from_beats(1.0)
-                     temp_beats = 1.0 * (0.5 ** u_count) + float(h_count)
-                     if dot: temp_beats *= 1.5
-                     current_beats = temp_beats
-
-             line += token + " "
+        for token, current_beats in self.jpw_voice_tokens: # 拍數已於 parse() 時算好
+             line_parts.append(token)
              token_count += 1
              beats_in_bar += current_beats
 
              # 嘗試插入小節線
              if beats_in_bar >= beats_per_bar - 0.01: # 接近或超過一个小节
-                 line += "| "
+                 line_parts.append("|")
                  beats_in_bar = 0.0 # 重置拍數計數
                  bar_counter += 1
                  if bar_counter % 4 == 0: # 每 4 小節換行
-                     output.append(line.strip())
-                     line = "  "
+                     yield " ".join(line_parts)
+                     line_parts = []
                      token_count = 0
              elif token_count >= max_tokens_per_line: # 或達到 token 上限也換行
-                 output.append(line.strip())
-                 line = "  "
+                 yield " ".join(line_parts)
+                 line_parts = []
                  token_count = 0
 
-        if line.strip(): output.append(line.strip())
+        if line_parts: yield " ".join(line_parts)
+
+    def iter_jpw_lines(self):
+        """逐行產生 JPW 檔案內容"""
+        yield "// ************** Generated JPW File from MIDI **************"
+        yield ""
+        # 省略 .Options, .Fonts
+        yield ".Title"
+        if self.title: yield f"Title = {{{self.title}}}"
+        yield f"KeyAndMeters = {{{self.jpw_key_str},{self.jpw_time_sig}}}"
+        if self.jpw_tempo_str: yield f"Expression = {{{self.jpw_tempo_str}}}"
+        yield ""
+        yield ".Voice"
+        yield from self.iter_voice_lines()
         # 省略 .Words, .Attachments, .Page
-        output.extend(["", "// --- End of Generated Content ---"])
-        return "\n".join(output)
+        yield ""
+        yield "// --- End of Generated Content ---"
+
+    def build_jpw_output(self):
+        """格式化解析到的資訊為 JPW 字串"""
+        return "\n".join(self.iter_jpw_lines())
 
 # --- Main Execution ---
-def convert_midi_to_jpw(from_file, to_file):
+def convert_midi_to_jpw(from_file, to_file, verbose=False):
     converter = MidiToJpw()
+    converter.verbose = verbose
     if not converter.parse(from_file):
         print("錯誤：解析 MIDI 檔案失敗。")
         return
     try:
         jpw_output = converter.build_jpw_output()
         # JPW 常見編碼是 GBK/GB18030，但為了更廣泛兼容性先用 UTF-8
-        with io.open(to_file, "w", encoding='utf-8') as f_out:
-            f_out.write(jpw_output)
+        # 一次編碼、一次寫入位元組；換行符號仍依平台 (與原本文字模式寫入相同)
+        if os.linesep != "\n": jpw_output = jpw_output.replace("\n", os.linesep)
+        with open(to_file, "wb") as f_out:
+            f_out.write(jpw_output.encode('utf-8'))
         print(f"轉換完成 (基本): '{from_file}' -> '{to_file}'")
         print("注意：MIDI 轉 JPW 為基本轉換，結果可能需要大量審閱和修改。")
     except Exception as e:
@@ -311,7 +438,9 @@ if __name__ == '__main__':
     parser = OptionParser(usage="usage: %prog -f <input.mid> -t <output.jpw>")
     parser.add_option("-f", "--from", dest="from_file", help="輸入 MIDI 檔案 (.mid)")
     parser.add_option("-t", "--to", dest="to_file", help="輸出 JPW 檔案 (.jpw)")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                      help="逐一印出音軌、元數據及每個音符/休止符")
     (opts, args) = parser.parse_args()
     if not opts.from_file or not opts.to_file:
         parser.error("需要提供輸入 (-f) 和輸出 (-t) 檔案參數。")
-    convert_midi_to_jpw(opts.from_file, opts.to_file)
\ No newline at end of file
+    convert_midi_to_jpw(opts.from_file, opts.to_file, opts.verbose)
\ No newline at end of file
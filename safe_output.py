@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+""" Output-file helper shared by the converters: write to a temp file, replace the target only on success. """
+import os
+import errno
+import shutil
+import tempfile
+import contextlib
+
+@contextlib.contextmanager
+def replace_on_success(output_file, **open_kwargs):
+    """
+    Yields a temp file in output_file's directory that is renamed over output_file only once the block
+    completes. A failed run, or an input that is also the output, never truncates or deletes output_file;
+    the temp file is the only thing ever removed. open_kwargs go to NamedTemporaryFile (binary by default).
+    """
+    target = os.path.realpath(output_file) # Replace a symlink's target, as writing through it would
+    # Refuse what opening output_file for writing would refuse, with the same error
+    if os.path.isdir(target): raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), output_file)
+    if os.path.exists(target) and not os.access(target, os.W_OK): raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), output_file)
+    f_tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(target), prefix='.', suffix='.tmp', delete=False, **open_kwargs)
+    try:
+        with f_tmp: yield f_tmp
+        if os.path.isfile(target): shutil.copymode(target, f_tmp.name) # Keep the replaced file's permissions
+        else: umask = os.umask(0); os.umask(umask); os.chmod(f_tmp.name, 0o666 & ~umask) # New file: what open() would give
+        os.replace(f_tmp.name, target)
+    except BaseException:
+        try: os.remove(f_tmp.name)
+        except OSError: pass
+        raise